@@ -0,0 +1,270 @@
+# benchmark.py
+# Offline handler benchmark: drives synthetic updates through the real handlers in bot.py
+# with a recording fake Bot and the in-memory SQLite storage backend.
+#
+#   python benchmark.py --users 100,10000,1000000 --output results.json
+#   python benchmark.py --compare results.json --output new.json
+import argparse
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from telegram import Update
+import database
+import storage
+import sender
+import bot
+
+ADMIN_ID = bot.ADMIN_IDS[0]
+
+class FakeBot:
+    # Records every Bot API call instead of making it
+    defaults = None
+    id = 1
+    username = "BTS0BOT_BOT"
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            with self._lock:
+                self.calls.append(method)
+            return True
+        return call
+
+    def count(self):
+        with self._lock:
+            return len(self.calls)
+
+class FakeContext:
+    def __init__(self, fake_bot, user_data, args=None):
+        self.bot = fake_bot
+        self.user_data = user_data
+        self.chat_data = {}
+        self.bot_data = {}
+        self.args = args or []
+
+# --- In-memory SQLite backend with a round-trip counter -------------------------------------
+
+class RoundTripCounter:
+    def __init__(self):
+        self.by_thread = {}
+        self._lock = threading.Lock()
+
+    def add(self):
+        name = threading.current_thread().name
+        with self._lock:
+            self.by_thread[name] = self.by_thread.get(name, 0) + 1
+
+    def foreground(self):
+        with self._lock:
+            return self.by_thread.get(threading.main_thread().name, 0)
+
+    def background(self):
+        with self._lock:
+            return sum(n for name, n in self.by_thread.items() if name != threading.main_thread().name)
+
+def install_sqlite(counter):
+    class CountingCursor(storage.SQLiteCursor):
+        def execute(self, sql, params=()):
+            counter.add()
+            super().execute(sql, params)
+
+        def executemany(self, sql, seq):
+            counter.add()
+            super().executemany(sql, seq)
+
+    backend = storage.SQLiteBackend(":memory:", timeout=30)
+    backend.cursor_class = CountingCursor
+    database.backend = backend
+    database.setup_database()
+    return backend
+
+def seed(backend, user_count):
+    # Bulk-load straight through the raw connection, bypassing the per-call counters
+    insert_users = ("INSERT INTO users (telegram_id, username, chat_id, first_handshake_at, last_seen_at) "
+                    "VALUES (?, ?, ?, ?, ?)")
+    with backend.connection() as connection:
+        conn = connection.conn
+        for table in ("interactions", "subscriptions", "users", "command_scopes", "reminders_sent"):
+            conn.execute(f"DELETE FROM {table}")
+        today = datetime.now().date()
+        now = datetime.now()
+        batch = []
+        for telegram_id in range(1, user_count + 1):
+            batch.append((telegram_id, f"user{telegram_id}", telegram_id, now, now))
+            if len(batch) == 50000:
+                conn.executemany(insert_users, batch)
+                batch = []
+        batch.append((ADMIN_ID, "admin", ADMIN_ID, now, now))
+        conn.executemany(insert_users, batch)
+        # A third of users subscribe, half of those have paid
+        conn.executemany(
+            "INSERT INTO subscriptions (telegram_id, start_date, end_date, payment_confirmed, status) VALUES (?, ?, ?, ?, ?)",
+            ((tid, today, today + timedelta(days=tid % 30), tid % 2 == 0, "active" if tid % 2 == 0 else "pending")
+             for tid in range(1, user_count + 1, 3))
+        )
+
+# --- Synthetic updates ---------------------------------------------------------------------
+
+_update_ids = iter(range(1, 10 ** 9))
+
+def _user(telegram_id):
+    return {"id": telegram_id, "is_bot": False, "first_name": "Army", "username": f"user{telegram_id}"}
+
+def message_update(fake_bot, telegram_id, text):
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return Update.de_json({
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": text, "entities": entities,
+            "chat": {"id": telegram_id, "type": "private"}, "from": _user(telegram_id),
+        },
+    }, fake_bot)
+
+def callback_update(fake_bot, telegram_id, data):
+    return Update.de_json({
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)), "chat_instance": "1", "data": data, "from": _user(telegram_id),
+            "message": {"message_id": 1, "date": int(time.time()), "text": "picker",
+                        "chat": {"id": telegram_id, "type": "private"}, "from": _user(1)},
+        },
+    }, fake_bot)
+
+def scenarios(user_count):
+    # name -> function(rng) returning (handler, telegram_id, update builder, initial user_data)
+    def existing(rng):
+        return rng.randint(1, user_count)
+
+    return {
+        "start": lambda rng: (bot.start, existing(rng), lambda b, t: message_update(b, t, "/start"), {}),
+        "free_text": lambda rng: (bot.handle_message, existing(rng), lambda b, t: message_update(b, t, "hello"), {}),
+        "subscribe_button": lambda rng: (bot.handle_message, existing(rng), lambda b, t: message_update(b, t, "Subscribe"), {}),
+        "help_message": lambda rng: (bot.handle_message, existing(rng), lambda b, t: message_update(b, t, "I need help"),
+                                     {'help_mode': True}),
+        "admin_relay": lambda rng: (bot.handle_message, ADMIN_ID, lambda b, t: message_update(b, t, "hi from admin"),
+                                    {'chat_with': existing(rng)}),
+        "callback_chat": lambda rng: (bot.chat_callback, ADMIN_ID, lambda b, t, u=existing(rng): callback_update(b, t, f"chat_{u}"), {}),
+        "callback_confirm": lambda rng: (bot.confirm_payment_callback, ADMIN_ID,
+                                         lambda b, t, u=existing(rng): callback_update(b, t, f"confirm_{u}"), {}),
+        "callback_chat_page": lambda rng: (bot.chat_callback, ADMIN_ID,
+                                           lambda b, t, u=existing(rng): callback_update(b, t, f"chatpage_n_{u}"), {}),
+    }
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def wait_for_sends(timeout=30):
+    deadline = time.monotonic() + timeout
+    while sender.scheduler.stats()['chats'] and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+def run_scenario(fake_bot, counter, build, iterations, rng):
+    latencies, round_trips, api_calls = [], [], []
+    for _ in range(iterations):
+        handler, telegram_id, make_update, user_data = build(rng)
+        update = make_update(fake_bot, telegram_id)
+        context = FakeContext(fake_bot, dict(user_data))
+        trips_before, calls_before = counter.foreground(), fake_bot.count()
+        started = time.perf_counter()
+        handler(update, context)
+        latencies.append((time.perf_counter() - started) * 1000)
+        round_trips.append(counter.foreground() - trips_before)
+        # Sends queued on the scheduler still belong to this update
+        wait_for_sends()
+        api_calls.append(fake_bot.count() - calls_before)
+    return {
+        "p50_ms": round(_percentile(latencies, 0.50), 3),
+        "p99_ms": round(_percentile(latencies, 0.99), 3),
+        "db_round_trips_per_update": round(sum(round_trips) / iterations, 3),
+        "api_calls_per_update": round(sum(api_calls) / iterations, 3),
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+def compare(baseline, current):
+    print(f"\nComparison against {baseline.get('commit')}:")
+    for users, handlers in current["results"].items():
+        for name, result in handlers.items():
+            old = baseline.get("results", {}).get(users, {}).get(name)
+            if not old:
+                continue
+            changes = ", ".join(
+                f"{metric} {old[metric]} -> {result[metric]}"
+                for metric in ("p50_ms", "p99_ms", "db_round_trips_per_update", "api_calls_per_update")
+                if old[metric] != result[metric]
+            )
+            print(f"  {users:>8} users  {name:<20} {changes or 'unchanged'}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bot.py handlers offline")
+    parser.add_argument("--users", default="100,1000,10000,100000",
+                        help="comma-separated user counts (e.g. 100,1000,1000000)")
+    parser.add_argument("--iterations", type=int, default=200, help="updates per handler and user count")
+    parser.add_argument("--scenarios", help="comma-separated subset of scenarios to run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="JSON results from an earlier run to diff against")
+    args = parser.parse_args(argv)
+
+    counter = RoundTripCounter()
+    backend = install_sqlite(counter)
+    fake_bot = FakeBot()
+    sender.scheduler.per_chat_interval = 0
+    sender.scheduler._bucket.rate = sender.scheduler._bucket.capacity = 1e9
+    sender.start(fake_bot)
+    database.interaction_logger.start()
+    database.counters.start()
+
+    results = {}
+    try:
+        for user_count in [int(n) for n in args.users.split(",")]:
+            print(f"Seeding {user_count} users...", file=sys.stderr)
+            seed(backend, user_count)
+            database.clear_caches()
+            rng = random.Random(args.seed)
+            results[str(user_count)] = {}
+            for name, build in scenarios(user_count).items():
+                if args.scenarios and name not in args.scenarios.split(","):
+                    continue
+                result = run_scenario(fake_bot, counter, build, args.iterations, rng)
+                results[str(user_count)][name] = result
+                print(f"{user_count:>8} users  {name:<20} p50 {result['p50_ms']:>8.3f} ms  p99 {result['p99_ms']:>8.3f} ms  "
+                      f"db {result['db_round_trips_per_update']:>6.2f}  api {result['api_calls_per_update']:>5.2f}",
+                      file=sys.stderr)
+    finally:
+        database.interaction_logger.stop()
+        database.counters.stop()
+        sender.stop()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "iterations": args.iterations,
+        "background_db_round_trips": counter.background(),
+        "interaction_logger": database.interaction_logger.stats(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
@@ -1,68 +1,163 @@
 # bot.py
+import logging
 import os
 import time
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
+import hashlib
+import threading
+import tempfile
+from concurrent.futures import wait
+from telegram.ext import CommandHandler, MessageHandler, Filters, CallbackQueryHandler
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
 from telegram.error import NetworkError
 import database
+import sender
+import broadcasts
+import webhook
+import executors
+import metrics
+import persistence
+import retention
+import expiry
+import tickets
 from datetime import datetime, timedelta
 
+logger = logging.getLogger(__name__)
+
 # Retrieve the bot token from environment variables
 TOKEN = os.getenv("TOKEN")
 PAYMENT_ADMIN = "@BTS_SUBSCRIPTION"  # First admin for payment
 MAIN_ADMIN = "@BTSADMIN0"  # Second admin for main chat
 ADMIN_IDS = [7104554772, 7105191693]  # List of admin IDs
-
-def get_user_keyboard(telegram_id):
+PAGE_SIZE = 10  # Users per page in inline pickers
+USERS_PAGE_SIZE = 50  # Users per /users message, well under Telegram's 4096-character limit
+REMINDER_THRESHOLDS = (3, 1, 0)  # Days before end_date at which a reminder goes out
+REMINDER_GRACE_DAYS = 7  # A final reminder that was missed still goes out this many days after end_date
+REMINDER_INTERVAL = int(os.getenv("REMINDER_INTERVAL", 3600))  # Seconds between scheduled reminder runs
+reminder_lock = threading.Lock()
+_reminders_in_flight = set()  # (telegram_id, end_date, threshold) queued but not yet delivered
+_reminders_in_flight_lock = threading.Lock()
+
+def get_user_keyboard(telegram_id, paid=None):
     # Base keyboard for all users
     keyboard = [["Subscribe"], ["Help"], ["Exit"]]
-    # Add "Chat with Main Admin" button if the user has paid
-    if database.has_paid(telegram_id):
+    # Add "Chat with Main Admin" button if the user has paid (callers that know can pass paid)
+    if paid if paid is not None else database.has_paid(telegram_id):
         keyboard.insert(0, ["Chat with Your Favorite BTS Artist 🌟"])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def set_user_commands(context, telegram_id):
-    # Define commands for non-admins
-    user_commands = [
-        BotCommand("start", "Register with @BTS0BOT_BOT"),
-        BotCommand("subscribe", "Subscribe to chat with your favorite BTS artist"),
-        BotCommand("help", "Get support from BTS admins")
-    ]
-    # Define commands for admins
-    admin_commands = [
-        BotCommand("start", "Register with @BTS0BOT_BOT"),
-        BotCommand("users", "(Admin) List all users"),
-        BotCommand("chat", "(Admin) Chat with a user"),
-        BotCommand("broadcast", "(Admin) Broadcast a message to all users"),
-        BotCommand("remind", "(Admin) Send subscription reminders"),
-        BotCommand("exit", "(Admin) Exit a chat session"),
-        BotCommand("pending_payments", "(Admin) View pending payments"),
-        BotCommand("confirm_payment", "(Admin) Confirm a payment")
-    ]
-    # Set commands based on user role
-    commands = admin_commands if telegram_id in ADMIN_IDS else user_commands
+# Commands for non-admins
+USER_COMMANDS = [
+    BotCommand("start", "Register with @BTS0BOT_BOT"),
+    BotCommand("subscribe", "Subscribe to chat with your favorite BTS artist"),
+    BotCommand("help", "Get support from BTS admins")
+]
+# Commands for admins
+ADMIN_COMMANDS = [
+    BotCommand("start", "Register with @BTS0BOT_BOT"),
+    BotCommand("users", "(Admin) List all users"),
+    BotCommand("chat", "(Admin) Chat with a user"),
+    BotCommand("tickets", "(Admin) Open help requests"),
+    BotCommand("broadcast", "(Admin) Broadcast a message to all users"),
+    BotCommand("broadcast_status", "(Admin) Show broadcast progress"),
+    BotCommand("remind", "(Admin) Send subscription reminders"),
+    BotCommand("stats", "(Admin) Daily activity, or /stats runtime"),
+    BotCommand("stats_rebuild", "(Admin) Recompute the daily stats"),
+    BotCommand("export", "(Admin) Download users, subscriptions or interactions"),
+    BotCommand("exit", "(Admin) Exit a chat session"),
+    BotCommand("pending_payments", "(Admin) View pending payments"),
+    BotCommand("confirm_payment", "(Admin) Confirm payments by Telegram ID")
+]
+
+def command_set_version(role, commands):
+    # Changes whenever a command list is edited, so stale chats get the new set
+    digest = hashlib.sha1("\n".join(f"{c.command}:{c.description}" for c in commands).encode()).hexdigest()
+    return f"{role}:{digest[:16]}"
+
+RESYNC_BATCH_SIZE = 100  # set_my_commands calls in flight during a resync
+_commands_pending = set()  # Chats with a set_my_commands call queued
+_commands_lock = threading.Lock()
+
+def apply_user_commands(telegram_id, force=False, bulk=False):
+    # Set commands based on user role, skipping the API call if this chat already has them.
+    # The call goes through the send scheduler; returns its future, or None if nothing was queued.
+    role = "admin" if telegram_id in ADMIN_IDS else "user"
+    commands = ADMIN_COMMANDS if role == "admin" else USER_COMMANDS
+    version = command_set_version(role, commands)
+    if not force and database.get_command_scope_version(telegram_id) == version:
+        return None
+    with _commands_lock:
+        if telegram_id in _commands_pending:
+            return None
+        _commands_pending.add(telegram_id)
+
+    def applied(_):
+        # Only a call Telegram accepted counts as applied
+        with _commands_lock:
+            _commands_pending.discard(telegram_id)
+        database.save_command_scope(telegram_id, role, version)
+
+    def failed(e):
+        with _commands_lock:
+            _commands_pending.discard(telegram_id)
+        logger.warning(f"Failed to set commands for {telegram_id}: {e}")
+
     # Use BotCommandScopeChat for the scope
-    scope = BotCommandScopeChat(chat_id=telegram_id)
-    context.bot.set_my_commands(commands=commands, scope=scope)
+    future = sender.set_my_commands(telegram_id, commands, BotCommandScopeChat(chat_id=telegram_id), bulk=bulk)
+    sender.on_done(future, applied, failed)
+    return future
+
+def set_user_commands(context, telegram_id):
+    try:
+        apply_user_commands(telegram_id)
+    except Exception as e:
+        logger.warning(f"Failed to set commands for {telegram_id}: {e}")
+
+def resync_commands(force=False):
+    # One-shot bulk pass after the command lists change (RESYNC_COMMANDS=1 at startup). Calls
+    # share the scheduler's rate limit and RetryAfter handling; waiting on each batch keeps
+    # the queue from holding the whole user base at once.
+    updated = failed = 0
+    batch = []
+
+    def settle():
+        nonlocal updated, failed
+        done, _ = wait(batch)
+        errors = sum(1 for future in done if future.exception() is not None)
+        updated += len(done) - errors
+        failed += errors
+        batch.clear()
+
+    for user in database.iter_users():
+        try:
+            future = apply_user_commands(user['telegram_id'], force=force, bulk=True)
+        except Exception as e:
+            logger.warning(f"Failed to resync commands for {user['telegram_id']}: {e}")
+            continue
+        if future is not None:
+            batch.append(future)
+        if len(batch) >= RESYNC_BATCH_SIZE:
+            settle()
+    settle()
+    logger.info(f"Command resync finished: {updated} chats updated, {failed} failed")
 
 def register_user(update, context):
     user = update.message.from_user
     chat_id = update.message.chat_id
     telegram_id = user.id
     username = user.username if user.username else "NoUsername"
-    print(f"Registering user: {telegram_id}, Username: {username}, Chat ID: {chat_id}")  # Debug
+    logger.debug(f"Registering user: {telegram_id}, Username: {username}, Chat ID: {chat_id}")
 
     try:
-        database.save_user(telegram_id, username, chat_id)
+        database.save_user(telegram_id, username, chat_id, handshake=True)
         database.log_interaction(telegram_id, "handshake")
-        print("User saved to database")  # Debug
+        logger.debug("User saved to database")
         return True
     except Exception as e:
-        print(f"Database error: {e}")  # Debug
+        logger.error(f"Database error: {e}")
         return False
 
 def start(update, context):
-    print("Received /start command")  # Debug
+    logger.debug("Received /start command")
     telegram_id = update.message.from_user.id
     username = update.message.from_user.username if update.message.from_user.username else "User"
     # Set commands based on user role
@@ -87,7 +182,7 @@ def help_command(update, context):
     update.message.reply_text("Please type your message for the BTS admins, or type /cancel to stop:")
 
 def handle_message(update, context):
-    print("Received message")  # Debug
+    logger.debug("Received message")
     telegram_id = update.message.from_user.id
     message_text = update.message.text
 
@@ -145,26 +240,16 @@ def handle_help_message(update, context):
         update.message.reply_text("Help request cancelled.", reply_markup=get_user_keyboard(telegram_id))
         return True
 
-    # Send the user's message to all admins
-    users = database.get_all_users()
-    user_dict = {user['telegram_id']: user for user in users}
-    user = user_dict.get(telegram_id)
-
-    for admin_id in ADMIN_IDS:
-        try:
-            context.bot.send_message(
-                chat_id=admin_id,
-                text=f"Help request from {user['username']} (ID: {telegram_id}):\n{message}"
-            )
-        except Exception as e:
-            print(f"Failed to send help request to admin {admin_id}: {e}")
+    # Store it as a ticket; the admins are notified in the background
+    user = database.get_user(telegram_id)
+    ticket_id = tickets.open_ticket(telegram_id, user['username'] if user else None, message, ADMIN_IDS)
 
-    update.message.reply_text("Your message has been sent to the BTS admins. Please wait for a response. 💜", reply_markup=get_user_keyboard(telegram_id))
+    update.message.reply_text(f"Your message has been sent to the BTS admins (ticket #{ticket_id}). Please wait for a response. 💜", reply_markup=get_user_keyboard(telegram_id))
     del context.user_data['help_mode']
     return True
 
 def subscribe(update, context):
-    print("Received Subscribe button click")  # Debug
+    logger.debug("Received Subscribe button click")
     telegram_id = update.message.from_user.id
 
     if not database.user_exists(telegram_id):
@@ -191,29 +276,125 @@ def subscribe(update, context):
         )
         database.log_interaction(telegram_id, "subscribe")
     except Exception as e:
-        print(f"Database error: {e}")  # Debug
+        logger.error(f"Database error: {e}")
         update.message.reply_text("Failed to process subscription. Please try again.", reply_markup=get_user_keyboard(telegram_id))
 
 def pending_payments(update, context):
-    print("Received /pending_payments command")  # Debug
+    logger.debug("Received /pending_payments command")
     telegram_id = update.message.from_user.id
 
     if telegram_id not in ADMIN_IDS:
         update.message.reply_text("You are not authorized to use this command.")
         return
 
-    pending = database.get_pending_payments()
-    if not pending:
+    reply_markup = pending_payments_keyboard(get_confirm_selection(context))
+    if not reply_markup:
         update.message.reply_text("No pending payments found.")
         return
 
+    update.message.reply_text("Users with pending payments:", reply_markup=reply_markup)
+
+def page_cursor(data):
+    # "<prefix>_n_<id>" pages forwards after id, "<prefix>_p_<id>" backwards before it
+    _, direction, cursor_id = data.split("_")
+    if direction == "n":
+        return {'after_id': int(cursor_id)}
+    return {'before_id': int(cursor_id)}
+
+def user_page_keyboard(rows, has_prev, has_next, button_prefix, page_prefix, extra_rows=(), selected=()):
     buttons = [
-        InlineKeyboardButton(f"{user['username']} (ID: {user['telegram_id']})", callback_data=f"confirm_{user['telegram_id']}")
-        for user in pending
+        InlineKeyboardButton(
+            f"{SELECTED_MARK if user['telegram_id'] in selected else ''}{user['username']} (ID: {user['telegram_id']})",
+            callback_data=f"{button_prefix}_{user['telegram_id']}"
+        )
+        for user in rows
     ]
     keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("Users with pending payments:", reply_markup=reply_markup)
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("« Previous", callback_data=f"{page_prefix}_p_{rows[0]['telegram_id']}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next »", callback_data=f"{page_prefix}_n_{rows[-1]['telegram_id']}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.extend(extra_rows)
+    return InlineKeyboardMarkup(keyboard)
+
+SELECTED_MARK = "✅ "
+BULK_CONFIRM_LIMIT = 500
+PAYMENT_CONFIRMED_TEXT = "Your payment has been confirmed! You can now chat with your favorite BTS artist! 🌟🎤"
+
+def pending_payments_keyboard(selected=(), **cursor):
+    # Tapping a user toggles them in the selection; "Confirm selected" confirms them together
+    rows, has_prev, has_next = database.get_pending_payments_page(limit=PAGE_SIZE, **cursor)
+    if not rows:
+        return None
+    actions = [
+        [InlineKeyboardButton(f"Confirm selected ({len(selected)})", callback_data="confirmbulk"),
+         InlineKeyboardButton("Select page", callback_data="confirmall")],
+        [InlineKeyboardButton("Clear selection", callback_data="confirmclear")],
+    ]
+    return user_page_keyboard(rows, has_prev, has_next, "confirmsel", "confirmpage", actions, set(selected))
+
+def mark_selection(markup, selection):
+    # Re-labels the page already on screen instead of querying it again
+    selected = set(selection)
+    keyboard = []
+    for row in markup.inline_keyboard:
+        buttons = []
+        for button in row:
+            text, data = button.text, button.callback_data
+            if data.startswith("confirmsel_"):
+                if text.startswith(SELECTED_MARK):
+                    text = text[len(SELECTED_MARK):]
+                if int(data.split("_")[1]) in selected:
+                    text = SELECTED_MARK + text
+            elif data == "confirmbulk":
+                text = f"Confirm selected ({len(selection)})"
+            buttons.append(InlineKeyboardButton(text, callback_data=data))
+        keyboard.append(buttons)
+    return InlineKeyboardMarkup(keyboard)
+
+def page_user_ids(markup):
+    return [int(button.callback_data.split("_")[1]) for row in markup.inline_keyboard for button in row
+            if button.callback_data.startswith("confirmsel_")]
+
+def get_confirm_selection(context):
+    return list(context.user_data.get('confirm_selection', []))
+
+def set_confirm_selection(context, selection):
+    if selection:
+        context.user_data['confirm_selection'] = selection
+    else:
+        context.user_data.pop('confirm_selection', None)
+
+def notify_payments_confirmed(confirmed):
+    # One batch for the whole confirmation, using the chat_ids the confirm query returned
+    futures = sender.send_many(
+        [(row['chat_id'], PAYMENT_CONFIRMED_TEXT) for row in confirmed],
+        reply_markup=get_user_keyboard(None, paid=True)
+    )
+    for row, future in zip(confirmed, futures):
+        sender.on_done(
+            future,
+            on_failure=lambda e, user_id=row['telegram_id']: logger.warning(f"Failed to notify user {user_id} of payment: {e}")
+        )
+
+def confirmation_summary(requested, confirmed, shown=20):
+    confirmed_ids = [row['telegram_id'] for row in confirmed]
+    confirmed_set = set(confirmed_ids)
+    skipped = [user_id for user_id in requested if user_id not in confirmed_set]
+
+    def id_list(ids):
+        more = f" (+{len(ids) - shown} more)" if len(ids) > shown else ""
+        return ", ".join(str(user_id) for user_id in ids[:shown]) + more
+
+    lines = []
+    if confirmed_ids:
+        lines.append(f"Payment confirmed for {len(confirmed_ids)} user(s): {id_list(confirmed_ids)}")
+    if skipped:
+        lines.append(f"No pending payment for {len(skipped)} ID(s): {id_list(skipped)}")
+    return "\n".join(lines)
 
 def confirm_payment_callback(update, context):
     query = update.callback_query
@@ -224,23 +405,51 @@ def confirm_payment_callback(update, context):
         query.message.reply_text("You are not authorized to use this command.")
         return
 
-    user_id = int(query.data.split("_")[1])
-    database.confirm_payment(user_id)
-    query.message.reply_text(f"Payment confirmed for user ID {user_id}.")
+    data = query.data
+    selection = get_confirm_selection(context)
+    if data.startswith("confirmpage_"):
+        reply_markup = pending_payments_keyboard(selection, **page_cursor(data))
+        if reply_markup:
+            query.edit_message_reply_markup(reply_markup=reply_markup)
+        return
 
-    # Notify the user
-    users = database.get_all_users()
-    user_dict = {user['telegram_id']: user for user in users}
-    user = user_dict.get(user_id)
-    if user:
-        context.bot.send_message(
-            chat_id=user['chat_id'],
-            text="Your payment has been confirmed! You can now chat with your favorite BTS artist! 🌟🎤",
-            reply_markup=get_user_keyboard(user_id)
-        )
+    if data in ("confirmall", "confirmclear") or data.startswith("confirmsel_"):
+        if data == "confirmclear":
+            updated = []
+        elif data == "confirmall":
+            updated = selection + [user_id for user_id in page_user_ids(query.message.reply_markup) if user_id not in selection]
+        else:
+            user_id = int(data.split("_")[1])
+            updated = [s for s in selection if s != user_id] if user_id in selection else selection + [user_id]
+        updated = updated[:BULK_CONFIRM_LIMIT]
+        if updated != selection:
+            set_confirm_selection(context, updated)
+            query.edit_message_reply_markup(reply_markup=mark_selection(query.message.reply_markup, updated))
+        return
+
+    if data == "confirmbulk":
+        user_ids = selection
+        if not user_ids:
+            query.message.reply_text("Tap users in the list to select them first.")
+            return
+    else:
+        # "confirm_<id>" buttons on lists sent before multi-select
+        user_ids = [int(data.split("_")[1])]
+
+    confirmed = database.confirm_payments(user_ids)
+    set_confirm_selection(context, [user_id for user_id in selection if user_id not in user_ids])
+    query.message.reply_text(confirmation_summary(user_ids, confirmed))
+    notify_payments_confirmed(confirmed)
+
+    # Confirmed users drop off the list
+    reply_markup = pending_payments_keyboard(get_confirm_selection(context))
+    if reply_markup:
+        query.edit_message_reply_markup(reply_markup=reply_markup)
+    else:
+        query.edit_message_text("No pending payments left.")
 
 def confirm_payment(update, context):
-    print("Received /confirm_payment command")  # Debug
+    logger.debug("Received /confirm_payment command")
     telegram_id = update.message.from_user.id
 
     if telegram_id not in ADMIN_IDS:
@@ -248,68 +457,91 @@ def confirm_payment(update, context):
         return
 
     if not context.args:
-        update.message.reply_text("Please provide the Telegram ID of the user. Usage: /confirm_payment <telegram_id>")
+        update.message.reply_text("Please provide the Telegram ID of the user(s). Usage: /confirm_payment <telegram_id> [telegram_id ...]")
         return
 
     try:
-        user_id = int(context.args[0])
-        database.confirm_payment(user_id)
-        update.message.reply_text(f"Payment confirmed for user ID {user_id}.")
-
-        # Notify the user
-        users = database.get_all_users()
-        user_dict = {user['telegram_id']: user for user in users}
-        user = user_dict.get(user_id)
-        if user:
-            context.bot.send_message(
-                chat_id=user['chat_id'],
-                text="Your payment has been confirmed! You can now chat with your favorite BTS artist! 🌟🎤",
-                reply_markup=get_user_keyboard(user_id)
-            )
+        user_ids = [int(value) for arg in context.args for value in arg.split(",") if value]
     except ValueError:
-        update.message.reply_text("Invalid Telegram ID. Please provide a numeric ID.")
+        update.message.reply_text("Invalid Telegram ID. Please provide numeric IDs.")
+        return
+    if len(user_ids) > BULK_CONFIRM_LIMIT:
+        update.message.reply_text(f"Please confirm at most {BULK_CONFIRM_LIMIT} IDs at a time.")
+        return
+
+    try:
+        confirmed = database.confirm_payments(user_ids)
     except Exception as e:
-        print(f"Error confirming payment: {e}")
+        logger.error(f"Error confirming payment: {e}")
         update.message.reply_text("Failed to confirm payment. Please try again.")
+        return
+    update.message.reply_text(confirmation_summary(user_ids, confirmed))
+    notify_payments_confirmed(confirmed)
 
 def list_users(update, context):
-    print("Received /users command")  # Debug
+    logger.debug("Received /users command")
     telegram_id = update.message.from_user.id
 
     if telegram_id not in ADMIN_IDS:
         update.message.reply_text("You are not authorized to use this command.")
         return
 
-    users = database.get_users_with_handshake()
-    if not users:
+    page = users_page()
+    if not page:
         update.message.reply_text("No users found who have initiated a handshake.")
         return
 
-    user_list = "\n".join([f"ID: {user['telegram_id']}, Username: {user['username']}, Chat ID: {user['chat_id']}" for user in users])
-    update.message.reply_text(f"Users who have initiated a handshake:\n{user_list}")
+    text, reply_markup = page
+    update.message.reply_text(text, reply_markup=reply_markup)
+
+def users_page(**cursor):
+    rows, has_prev, has_next = database.get_users_with_handshake_page(limit=USERS_PAGE_SIZE, **cursor)
+    if not rows:
+        return None
+    user_list = "\n".join([f"ID: {user['telegram_id']}, Username: {user['username']}, Chat ID: {user['chat_id']}" for user in rows])
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("« Previous", callback_data=f"userspage_p_{rows[0]['telegram_id']}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next »", callback_data=f"userspage_n_{rows[-1]['telegram_id']}"))
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+    return f"Users who have initiated a handshake:\n{user_list}", reply_markup
+
+def list_users_callback(update, context):
+    query = update.callback_query
+    query.answer()
+
+    if query.from_user.id not in ADMIN_IDS:
+        query.message.reply_text("You are not authorized to use this command.")
+        return
+
+    page = users_page(**page_cursor(query.data))
+    if page:
+        text, reply_markup = page
+        query.edit_message_text(text, reply_markup=reply_markup)
 
 def chat(update, context):
-    print("Received /chat command")  # Debug
+    logger.debug("Received /chat command")
     telegram_id = update.message.from_user.id
 
     if telegram_id not in ADMIN_IDS:
         update.message.reply_text("You are not authorized to use this command.")
         return
 
-    users = database.get_all_users()
-    if not users:
+    reply_markup = chat_keyboard()
+    if not reply_markup:
         update.message.reply_text("No users found to chat with.")
         return
 
-    buttons = [
-        InlineKeyboardButton(f"{user['username']} (ID: {user['telegram_id']})", callback_data=f"chat_{user['telegram_id']}")
-        for user in users
-    ]
-    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
-    keyboard.append([InlineKeyboardButton("Search for a user", callback_data="search_user")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
     update.message.reply_text("Select a user to chat with:", reply_markup=reply_markup)
 
+def chat_keyboard(**cursor):
+    rows, has_prev, has_next = database.get_users_page(limit=PAGE_SIZE, **cursor)
+    if not rows:
+        return None
+    search = [[InlineKeyboardButton("Search for a user", callback_data="search_user")]]
+    return user_page_keyboard(rows, has_prev, has_next, "chat", "chatpage", search)
+
 def chat_callback(update, context):
     query = update.callback_query
     query.answer()
@@ -324,21 +556,77 @@ def chat_callback(update, context):
         query.message.reply_text("Please type the username or ID of the user you want to chat with (or type /cancel to stop):")
         return
 
+    if query.data.startswith("chatpage_"):
+        reply_markup = chat_keyboard(**page_cursor(query.data))
+        if reply_markup:
+            query.edit_message_reply_markup(reply_markup=reply_markup)
+        return
+
     target_id = int(query.data.split("_")[1])
-    users = database.get_all_users()
-    user_dict = {user['telegram_id']: user for user in users}
-    target_user = user_dict.get(target_id)
+    target_user = database.get_user(target_id)
 
     if not target_user:
         query.message.reply_text(f"User with ID {target_id} not found.")
         return
 
     context.user_data['chat_with'] = target_id
+    context.user_data.pop('ticket_id', None)
     query.message.reply_text(
         f"--- Chat with {target_user['username']} (ID: {target_id}) ---\n"
         f"Send a message to them, or type /exit to stop chatting."
     )
 
+def ticket_callback(update, context):
+    # "Claim #id" on a help request: the first admin to tap it gets the ticket and a /chat session
+    query = update.callback_query
+    query.answer()
+    telegram_id = query.from_user.id
+
+    if telegram_id not in ADMIN_IDS:
+        query.message.reply_text("You are not authorized to use this command.")
+        return
+
+    ticket_id = int(query.data.split("_")[1])
+    claimed = database.claim_ticket(ticket_id, telegram_id)
+    ticket = database.get_ticket(ticket_id)
+    if not ticket:
+        query.message.reply_text(f"Ticket #{ticket_id} not found.")
+        return
+    # The admin holding an unanswered ticket can tap it again to resume the session
+    resumed = ticket['claimed_by'] == telegram_id and ticket['status'] == "claimed"
+    if not claimed and not resumed:
+        owner = "you" if ticket['claimed_by'] == telegram_id else f"admin {ticket['claimed_by']}"
+        query.message.reply_text(f"Ticket #{ticket_id} was already claimed by {owner} ({ticket['status']}).")
+        return
+
+    context.user_data['chat_with'] = ticket['telegram_id']
+    context.user_data['ticket_id'] = ticket_id
+    query.message.reply_text(
+        f"--- Ticket #{ticket_id}: chat with {ticket['username'] or 'NoUsername'} (ID: {ticket['telegram_id']}) ---\n"
+        f"{ticket['message']}\n\nSend your answer, or type /exit to stop chatting."
+    )
+
+def list_tickets(update, context):
+    logger.debug("Received /tickets command")
+    telegram_id = update.message.from_user.id
+
+    if telegram_id not in ADMIN_IDS:
+        update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    waiting = database.get_open_tickets(PAGE_SIZE)
+    if not waiting:
+        update.message.reply_text("No open help tickets.")
+        return
+
+    lines = [f"#{t['id']} {t['username'] or 'NoUsername'} (ID: {t['telegram_id']})"
+             + (f" [claimed by {t['claimed_by']}]" if t['status'] == "claimed" else "")
+             + f": {t['message'][:80]}" for t in waiting]
+    buttons = [[InlineKeyboardButton(f"Claim #{t['id']}", callback_data=f"ticket_{t['id']}")]
+               for t in waiting if t['status'] == "open"]
+    update.message.reply_text("Open help tickets:\n" + "\n".join(lines),
+                              reply_markup=InlineKeyboardMarkup(buttons) if buttons else None)
+
 def handle_user_search(update, context):
     telegram_id = update.message.from_user.id
     if telegram_id not in ADMIN_IDS or not context.user_data.get('searching_users'):
@@ -350,11 +638,7 @@ def handle_user_search(update, context):
         update.message.reply_text("Search cancelled.")
         return True
 
-    users = database.get_all_users()
-    filtered_users = [
-        user for user in users
-        if search_query in str(user['telegram_id']) or (user['username'] and search_query in user['username'].lower())
-    ]
+    filtered_users = database.search_users(search_query)
 
     if not filtered_users:
         update.message.reply_text("No users found matching your search. Try again or type /cancel.")
@@ -370,6 +654,11 @@ def handle_user_search(update, context):
     del context.user_data['searching_users']
     return True
 
+# Relay sends that failed, as admin id -> target id. Send callbacks run on sender threads,
+# so they only record the failure; the admin's next update ends the session.
+_failed_relays = {}
+_failed_relays_lock = threading.Lock()
+
 def handle_admin_chat_message(update, context):
     telegram_id = update.message.from_user.id
     if telegram_id not in ADMIN_IDS or 'chat_with' not in context.user_data:
@@ -378,125 +667,377 @@ def handle_admin_chat_message(update, context):
     target_id = context.user_data['chat_with']
     message = update.message.text
 
+    with _failed_relays_lock:
+        failed_target = _failed_relays.pop(telegram_id, None)
+    if failed_target == target_id:
+        del context.user_data['chat_with']
+        context.user_data.pop('ticket_id', None)
+        update.message.reply_text(
+            f"--- Chat session with user {target_id} ended because a message could not be delivered. "
+            f"This message was not sent. ---"
+        )
+        return True
+
     if message == "/exit":
         del context.user_data['chat_with']
+        context.user_data.pop('ticket_id', None)
         update.message.reply_text("--- Chat session ended ---")
         return True
 
-    users = database.get_all_users()
-    user_dict = {user['telegram_id']: user for user in users}
-    target_user = user_dict.get(target_id)
+    target_user = database.get_user(target_id)
 
     if not target_user:
         update.message.reply_text(f"User with ID {target_id} not found.")
         del context.user_data['chat_with']
+        context.user_data.pop('ticket_id', None)
         return True
 
     chat_id = target_user['chat_id']
-    try:
-        context.bot.send_message(chat_id=chat_id, text=f"Message from BTS Admin: {message} 💜")
-        print(f"Sent message to chat_id: {chat_id}")  # Debug
-        update.message.reply_text(f"Message sent to {target_user['username']}: {message}")
-    except Exception as e:
-        print(f"Failed to send message to chat_id {chat_id}: {e}")  # Debug
-        update.message.reply_text(f"Failed to send message to user {target_id}: {e}")
-        del context.user_data['chat_with']
-        return True
 
+    # The first reply in a ticket's session answers it. Done here, on the admin's own
+    # executor, so the change is persisted with this update.
+    ticket_id = context.user_data.pop('ticket_id', None)
+    if ticket_id is not None:
+        database.answer_ticket(ticket_id)
+
+    def delivered(_):
+        logger.debug(f"Sent message to chat_id: {chat_id}")
+        sender.send_message(telegram_id, f"Message sent to {target_user['username']}: {message}")
+
+    def failed(e):
+        logger.warning(f"Failed to send message to chat_id {chat_id}: {e}")
+        with _failed_relays_lock:
+            _failed_relays[telegram_id] = target_id
+        sender.send_message(telegram_id, f"Failed to send message to user {target_id}: {e}")
+
+    sender.on_done(sender.send_message(chat_id, f"Message from BTS Admin: {message} 💜"), delivered, failed)
     return True
 
 def broadcast(update, context):
-    print("Received /broadcast command")  # Debug
+    logger.debug("Received /broadcast command")
     telegram_id = update.message.from_user.id
 
     if telegram_id not in ADMIN_IDS:
         update.message.reply_text("You are not authorized to use this command.")
         return
 
-    if not context.args:
-        update.message.reply_text("Please provide a message to broadcast. Usage: /broadcast <message>")
+    audience, audience_days, words = broadcasts.parse_audience(context.args)
+    if not words:
+        update.message.reply_text(
+            "Please provide a message to broadcast. Usage: /broadcast [all|paid|unpaid|expiring:<days>|handshake] <message>"
+        )
         return
 
-    message = " ".join(context.args)
-    print(f"Broadcasting message: {message}")  # Debug
+    message = " ".join(words)
+    logger.debug(f"Broadcasting message to {audience}: {message}")
+
+    # Runs in the background; progress is checkpointed so a restart resumes it
+    broadcast_id = broadcasts.start_broadcast(message, audience, audience_days, telegram_id)
+    update.message.reply_text(f"Broadcast #{broadcast_id} started. Use /broadcast_status {broadcast_id} to follow it. 📢")
+
+def broadcast_status(update, context):
+    logger.debug("Received /broadcast_status command")
+    telegram_id = update.message.from_user.id
 
-    users = database.get_all_users()
-    if not users:
-        update.message.reply_text("No users found to broadcast to.")
+    if telegram_id not in ADMIN_IDS:
+        update.message.reply_text("You are not authorized to use this command.")
         return
 
-    successful_sends = 0
-    for user in users:
-        chat_id = user['chat_id']
+    if context.args:
         try:
-            context.bot.send_message(chat_id=chat_id, text=f"📢 Message from @BTS0BOT_BOT: {message} 💜")
-            print(f"Sent message to chat_id: {chat_id}")  # Debug
-            successful_sends += 1
-        except Exception as e:
-            print(f"Failed to send message to chat_id {chat_id}: {e}")  # Debug
+            found = database.get_broadcast(int(context.args[0]))
+        except ValueError:
+            update.message.reply_text("Invalid broadcast ID. Usage: /broadcast_status [broadcast_id]")
+            return
+        jobs = [found] if found else []
+    else:
+        jobs = database.get_recent_broadcasts()
+
+    if not jobs:
+        update.message.reply_text("No broadcasts found.")
+        return
+
+    update.message.reply_text("\n\n".join(broadcasts.format_status(job) for job in jobs))
+
+def reminder_threshold(days_left):
+    # The tightest threshold this subscription has reached; overdue ones share the last
+    return min([t for t in REMINDER_THRESHOLDS if t >= days_left] or [max(REMINDER_THRESHOLDS)])
+
+def _reminder_settled(reminder, error=None):
+    # Runs on a sender thread. Only delivered reminders go into the ledger; a failed one is
+    # picked up again by the next run.
+    with _reminders_in_flight_lock:
+        _reminders_in_flight.discard(reminder)
+    if error is None:
+        database.record_reminders([reminder])
+    else:
+        logger.warning(f"Failed to send reminder to user {reminder[0]}: {error}")
+
+def send_subscription_reminders():
+    # Remind each subscription at most once per threshold; returns how many were queued
+    with reminder_lock:
+        today = datetime.now().date()
+        due = database.get_due_reminders(today, max(REMINDER_THRESHOLDS), REMINDER_GRACE_DAYS)
+        queued = []
+        for sub in due:
+            end_date = sub['end_date']
+            days_left = (end_date - today).days
+            threshold = reminder_threshold(days_left)
+            if sub['reminded_threshold'] is not None and sub['reminded_threshold'] <= threshold:
+                continue
+            reminder = (sub['telegram_id'], end_date, threshold)
+            with _reminders_in_flight_lock:
+                if reminder in _reminders_in_flight:
+                    continue
+                _reminders_in_flight.add(reminder)
+            message = f"Reminder: Your subscription with @BTS0BOT_BOT ends on {end_date}. {days_left} days left! Please renew to continue chatting with your favorite BTS artist. 💜"
+            sender.on_done(
+                sender.send_message(sub['chat_id'], message, bulk=True),
+                on_success=lambda _, reminder=reminder: _reminder_settled(reminder),
+                on_failure=lambda e, reminder=reminder: _reminder_settled(reminder, e)
+            )
+            queued.append(reminder)
+    logger.debug(f"Queued {len(queued)} subscription reminders")
+    return len(queued)
+
+def reminder_job(context):
+    try:
+        send_subscription_reminders()
+    except Exception as e:
+        logger.error(f"Reminder job failed: {e}")
+
+def notify_subscriptions_expired(expired):
+    # Called by the expiry sweeper once per committed batch
+    futures = sender.send_many(
+        [(row['chat_id'], f"Your subscription with @BTS0BOT_BOT ended on {row['end_date']}. Tap Subscribe to renew and keep chatting with your favorite BTS artist. 💜")
+         for row in expired],
+        bulk=True,
+        reply_markup=get_user_keyboard(None, paid=False)
+    )
+    for row, future in zip(expired, futures):
+        sender.on_done(
+            future,
+            on_failure=lambda e, user_id=row['telegram_id']: logger.warning(f"Failed to notify user {user_id} of expiry: {e}")
+        )
 
-    update.message.reply_text(f"Broadcasted message to {successful_sends}/{len(users)} users successfully. 📢")
+def expiry_job(context):
+    try:
+        expiry.run(notify=notify_subscriptions_expired)
+    except Exception as e:
+        logger.error(f"Expiry job failed: {e}")
 
 def remind(update, context):
-    print("Received /remind command")  # Debug
+    logger.debug("Received /remind command")
     telegram_id = update.message.from_user.id
 
     if telegram_id not in ADMIN_IDS:
         update.message.reply_text("You are not authorized to use this command.")
         return
 
+    queued = send_subscription_reminders()
+    if not queued:
+        update.message.reply_text("No subscriptions are due for a reminder.")
+        return
+
+    update.message.reply_text(f"Reminders queued for {queued} users with upcoming or overdue subscriptions.")
+
+def format_runtime_stats():
+    uptime = max(1.0, time.time() - metrics.STARTED)
+    sends = sender.scheduler.stats()
+    interactions = database.interaction_logger.stats()
+    cache = database.entitlements.stats()
+    pool = database.pool_stats()
+    lines = [
+        f"Uptime: {int(uptime // 3600)}h {int(uptime % 3600 // 60)}m",
+        f"Sends: {sends['sent']} sent ({sends['sent'] / uptime:.2f}/s), {sends['failed']} failed, "
+        f"{sends['retried']} retried, {sends['queued']} queued",
+        f"Handlers queued: {executors.user_executor.stats()['queued']} user, {executors.admin_executor.stats()['queued']} admin",
+        f"Interactions: {interactions['queue_depth']} queued, {interactions['dropped']} dropped",
+        f"Entitlement cache: {cache['hits']} hits, {cache['misses']} misses",
+        f"DB pool: {pool['in_use']}/{pool['size']} in use",
+    ]
+    for title, histogram, label in (("Slowest handlers", metrics.handler_seconds, "handler"),
+                                    ("Slowest DB calls", metrics.db_seconds, "function")):
+        rows = metrics.summary(histogram, label, top=5)
+        if rows:
+            lines.append(f"\n{title} (calls, avg, p99):")
+            lines.extend(f"{name}: {calls}, {avg:.1f}ms, <{p99:.0f}ms" for name, calls, avg, p99 in rows)
+    return "\n".join(lines)
+
+STATS_DAYS = 7
+STATS_MAX_DAYS = 90
+STATS_LABELS = {"registrations": "new", "starts": "starts", "messages": "msgs",
+                "subscriptions": "subs", "confirmations": "paid", "expirations": "expired"}
+
+def format_daily_stats(days):
     today = datetime.now().date()
-    subscriptions = database.get_subscriptions()
-    if not subscriptions:
-        update.message.reply_text("No subscriptions found.")
+    since = today - timedelta(days=days - 1)
+    counts = database.get_daily_counters(since)
+    totals = dict.fromkeys(database.COUNTER_METRICS, 0)
+    lines = [f"Activity for the last {days} days:"]
+    for offset in range(days):
+        day = today - timedelta(days=offset)
+        row = counts.get(day, {})
+        for metric in database.COUNTER_METRICS:
+            totals[metric] += row.get(metric, 0)
+        lines.append(f"{day:%m-%d}: " + ", ".join(f"{row.get(m, 0)} {STATS_LABELS[m]}" for m in database.COUNTER_METRICS))
+    lines.append("Total: " + ", ".join(f"{totals[m]} {STATS_LABELS[m]}" for m in database.COUNTER_METRICS))
+    return "\n".join(lines)
+
+def stats(update, context):
+    logger.debug("Received /stats command")
+    telegram_id = update.message.from_user.id
+
+    if telegram_id not in ADMIN_IDS:
+        update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    # "/stats [days]" shows the daily counters, "/stats runtime" the process metrics
+    if context.args and context.args[0].lower() == "runtime":
+        update.message.reply_text(format_runtime_stats())
+        return
+    days = STATS_DAYS
+    if context.args:
+        if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= STATS_MAX_DAYS:
+            update.message.reply_text(f"Usage: /stats [days (1-{STATS_MAX_DAYS})] or /stats runtime")
+            return
+        days = int(context.args[0])
+    update.message.reply_text(format_daily_stats(days))
+
+def stats_rebuild(update, context):
+    logger.debug("Received /stats_rebuild command")
+    telegram_id = update.message.from_user.id
+
+    if telegram_id not in ADMIN_IDS:
+        update.message.reply_text("You are not authorized to use this command.")
         return
 
-    users = database.get_all_users()
-    user_dict = {user['telegram_id']: user for user in users}
+    update.message.reply_text("Rebuilding daily stats from the raw tables...")
+    started = time.monotonic()
+    rows = database.rebuild_daily_counters()
+    update.message.reply_text(f"Daily stats rebuilt: {rows} counters in {time.monotonic() - started:.1f}s.")
 
-    for sub in subscriptions:
-        telegram_id = sub['telegram_id']
-        end_date = sub['end_date']
-        days_left = (end_date - today).days
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Telegram's upload limit for bots
 
-        if days_left <= 3:
-            user = user_dict.get(telegram_id)
-            if user:
-                chat_id = user['chat_id']
-                message = f"Reminder: Your subscription with @BTS0BOT_BOT ends on {end_date}. {days_left} days left! Please renew to continue chatting with your favorite BTS artist. 💜"
-                try:
-                    context.bot.send_message(chat_id=chat_id, text=message)
-                    print(f"Sent reminder to chat_id: {chat_id}")  # Debug
-                except Exception as e:
-                    print(f"Failed to send reminder to chat_id {chat_id}: {e}")  # Debug
+def export(update, context):
+    logger.debug("Received /export command")
+    telegram_id = update.message.from_user.id
 
-    update.message.reply_text("Reminders sent to users with upcoming or overdue subscriptions.")
+    if telegram_id not in ADMIN_IDS:
+        update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    args = [arg.lower() for arg in context.args]
+    table = args[0] if args else None
+    fmt = args[1] if len(args) > 1 else "csv"
+    if table not in database.EXPORT_QUERIES or fmt not in database.EXPORT_FORMATS:
+        update.message.reply_text(
+            f"Usage: /export {'|'.join(database.EXPORT_QUERIES)} [{'|'.join(database.EXPORT_FORMATS)}]"
+        )
+        return
+
+    update.message.reply_text(f"Exporting {table}...")
+    filename = database.export_filename(table, fmt)
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, filename)
+        started = time.monotonic()
+        rows = database.export_file(table, fmt, path)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            update.message.reply_text(
+                f"The {table} export is {size / 1024 / 1024:.0f} MB, over Telegram's 50 MB limit. "
+                f"Run \"python database.py export {table} --format {fmt}\" on the server instead."
+            )
+            return
+        with open(path, "rb") as document:
+            update.message.reply_document(
+                document, filename=filename,
+                caption=f"{rows} {table} rows ({fmt}, gzip) in {time.monotonic() - started:.1f}s"
+            )
 
 def main():
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("subscribe", subscribe_command))
-    dp.add_handler(CommandHandler("help", help_command))
-    dp.add_handler(CommandHandler("users", list_users))
-    dp.add_handler(CommandHandler("chat", chat))
-    dp.add_handler(CallbackQueryHandler(chat_callback, pattern="^(chat_|search_user)"))
-    dp.add_handler(CallbackQueryHandler(confirm_payment_callback, pattern="^confirm_"))
-    dp.add_handler(CommandHandler("broadcast", broadcast))
-    dp.add_handler(CommandHandler("remind", remind))
-    dp.add_handler(CommandHandler("pending_payments", pending_payments))
-    dp.add_handler(CommandHandler("confirm_payment", confirm_payment))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
-
-    while True:
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    database.init_pool()
+    # A current schema costs one version read; migrations only run after an upgrade
+    database.migrate()
+    if database.CACHE_WARMUP_USERS > 0:
         try:
-            print("Bot is running...")
-            updater.start_polling(poll_interval=2.0)
-            updater.idle()
-            break
-        except NetworkError as e:
-            print(f"Network error: {e}. Retrying in 10 seconds...")
-            time.sleep(10)
+            logger.info(f"Warmed caches for {database.warm_caches(ADMIN_IDS)} users")
+        except Exception as e:
+            logger.warning(f"Cache warm-up failed: {e}")
+    # Conversation state survives restarts; it is read per user on first use and written in batches
+    updater = webhook.BotUpdater(TOKEN, use_context=True, persistence=persistence.persistence)
+    # Long batch jobs end at their next batch boundary instead of holding up the job queue
+    # shutdown, leaving time to flush everything below before the platform kills the process
+    updater.before_stop = (retention.stop, expiry.stop)
+    dp = updater.dispatcher
+    # Handlers run off the dispatcher thread, serialised per user (see executors.py)
+    dp.add_handler(CommandHandler("start", executors.run_for_user(start)))
+    dp.add_handler(CommandHandler("subscribe", executors.run_for_user(subscribe_command)))
+    dp.add_handler(CommandHandler("help", executors.run_for_user(help_command)))
+    dp.add_handler(CommandHandler("users", executors.run_for_user(list_users)))
+    dp.add_handler(CallbackQueryHandler(executors.run_for_user(list_users_callback), pattern="^userspage_"))
+    dp.add_handler(CommandHandler("chat", executors.run_for_user(chat)))
+    dp.add_handler(CallbackQueryHandler(executors.run_for_user(chat_callback), pattern="^(chat_|chatpage_|search_user)"))
+    dp.add_handler(CallbackQueryHandler(executors.run_for_user(confirm_payment_callback), pattern="^confirm"))
+    dp.add_handler(CommandHandler("tickets", executors.run_for_user(list_tickets)))
+    dp.add_handler(CallbackQueryHandler(executors.run_for_user(ticket_callback), pattern="^ticket_"))
+    dp.add_handler(CommandHandler("broadcast", executors.run_for_admin(broadcast)))
+    dp.add_handler(CommandHandler("broadcast_status", executors.run_for_user(broadcast_status)))
+    dp.add_handler(CommandHandler("remind", executors.run_for_admin(remind)))
+    dp.add_handler(CommandHandler("stats", executors.run_for_user(stats)))
+    dp.add_handler(CommandHandler("stats_rebuild", executors.run_for_admin(stats_rebuild)))
+    dp.add_handler(CommandHandler("export", executors.run_for_admin(export)))
+    dp.add_handler(CommandHandler("pending_payments", executors.run_for_user(pending_payments)))
+    dp.add_handler(CommandHandler("confirm_payment", executors.run_for_user(confirm_payment)))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, executors.run_for_user(handle_message)))
+
+    # Scheduled reminders; /remind stays available as an on-demand trigger
+    updater.job_queue.run_repeating(reminder_job, interval=REMINDER_INTERVAL, first=60)
+    # Expires lapsed subscriptions so has_paid stays a plain status read
+    updater.job_queue.run_repeating(expiry_job, interval=expiry.EXPIRY_INTERVAL, first=30)
+    # Sends again help tickets that reached no admin
+    updater.job_queue.run_repeating(tickets.job, interval=tickets.TICKET_RETRY_INTERVAL, first=60, context=ADMIN_IDS)
+    # Rolls up and archives old interactions in small throttled batches
+    updater.job_queue.run_repeating(retention.job, interval=retention.RETENTION_INTERVAL, first=300)
+
+    database.interaction_logger.start()
+    database.counters.start()
+    persistence.persistence.start()
+    if database.NGRAM_SEARCH:
+        threading.Thread(target=database.build_search_index, name="search-index", daemon=True).start()
+    sender.start(updater.bot)
+    # Queues through the sender, so it starts once the sender is running
+    if os.getenv("RESYNC_COMMANDS"):
+        force = os.getenv("RESYNC_COMMANDS") == "force"
+        threading.Thread(target=resync_commands, args=(force,), name="command-resync", daemon=True).start()
+    broadcasts.resume_broadcasts()
+    metrics.start_http_server()
+    try:
+        while True:
+            try:
+                logger.info(f"Bot is running ({webhook.BOT_MODE})...")
+                if webhook.BOT_MODE == "webhook":
+                    webhook.start_webhook(updater)
+                else:
+                    updater.start_polling(poll_interval=2.0)
+                updater.idle()
+                break
+            except NetworkError as e:
+                logger.warning(f"Network error: {e}. Retrying in 10 seconds...")
+                time.sleep(10)
+    finally:
+        # Deliver queued messages and flush queued interactions before the process exits.
+        # Repeated here for exits that didn't go through updater.stop().
+        retention.stop()
+        expiry.stop()
+        executors.shutdown()
+        persistence.persistence.stop()
+        broadcasts.stop()
+        sender.stop()
+        database.interaction_logger.stop()
+        database.counters.stop()
+        logger.info(f"Interaction logger stopped: {database.interaction_logger.stats()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,129 @@
+# broadcasts.py
+import logging
+import os
+import threading
+from concurrent.futures import wait
+from datetime import datetime
+import database
+import sender
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", 500))
+# A chunk that raises (e.g. the database is briefly unreachable) is retried with backoff;
+# after BROADCAST_MAX_RETRIES failures in a row the broadcast is marked failed and its
+# creator is told.
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 5))
+BROADCAST_MAX_BACKOFF = float(os.getenv("BROADCAST_MAX_BACKOFF", 60))
+
+_threads = {}
+_lock = threading.Lock()
+_stop = threading.Event()
+
+def parse_audience(args):
+    # "/broadcast [all|paid|unpaid|expiring[:days]|handshake] <message>"
+    if args:
+        name, _, days = args[0].lower().partition(":")
+        if name in database.BROADCAST_AUDIENCES:
+            if name == "expiring":
+                return name, int(days) if days.isdigit() else 3, args[1:]
+            return name, None, args[1:]
+    return "all", None, args
+
+def start_broadcast(message, audience, audience_days, created_by):
+    broadcast_id = database.create_broadcast(message, audience, audience_days, created_by)
+    _launch(broadcast_id)
+    return broadcast_id
+
+def resume_broadcasts():
+    # Pick up broadcasts that were still running when the process stopped
+    for broadcast in database.get_running_broadcasts():
+        database.abandon_pending_deliveries(broadcast['id'])
+        logger.info(f"Resuming broadcast {broadcast['id']} after user {broadcast['last_telegram_id']}")
+        _launch(broadcast['id'])
+
+def stop(timeout=30):
+    # Running broadcasts stop at their next checkpoint and resume on restart
+    _stop.set()
+    with _lock:
+        threads = list(_threads.values())
+    for thread in threads:
+        thread.join(timeout)
+
+def _launch(broadcast_id):
+    with _lock:
+        if broadcast_id in _threads:
+            return
+        thread = threading.Thread(target=_run, args=(broadcast_id,), name=f"broadcast-{broadcast_id}", daemon=True)
+        _threads[broadcast_id] = thread
+    thread.start()
+
+def _run(broadcast_id):
+    attempts = 0
+    try:
+        while not _stop.is_set():
+            try:
+                # A failed attempt may have left claimed deliveries behind; count them as unknown
+                _send_chunks(broadcast_id, abandon_pending=attempts > 0)
+                return
+            except Exception as e:
+                attempts += 1
+                if attempts > BROADCAST_MAX_RETRIES:
+                    logger.error(f"Broadcast {broadcast_id} failed after {attempts} attempts: {e}")
+                    _fail(broadcast_id)
+                    return
+                delay = min(BROADCAST_MAX_BACKOFF, 2 ** attempts)
+                logger.warning(f"Broadcast {broadcast_id} chunk failed, retrying in {delay}s: {e}")
+                _stop.wait(delay)
+    finally:
+        with _lock:
+            _threads.pop(broadcast_id, None)
+
+def _send_chunks(broadcast_id, abandon_pending=False):
+    # Sends chunk by chunk until the audience is exhausted or stop() is called
+    if abandon_pending:
+        database.abandon_pending_deliveries(broadcast_id)
+    broadcast = database.get_broadcast(broadcast_id)
+    text = f"📢 Message from @BTS0BOT_BOT: {broadcast['message']} 💜"
+    while not _stop.is_set():
+        recipients = database.get_broadcast_recipients(broadcast, CHUNK_SIZE)
+        if not recipients:
+            database.finish_broadcast(broadcast_id)
+            _report(broadcast_id)
+            return
+        database.claim_broadcast_recipients(broadcast_id, [r['telegram_id'] for r in recipients])
+        futures = [(r['telegram_id'], sender.send_message(r['chat_id'], text, bulk=True)) for r in recipients]
+        wait([future for _, future in futures])
+        results = []
+        for telegram_id, future in futures:
+            error = future.exception()
+            results.append((telegram_id, "failed" if error else "sent", str(error) if error else None))
+        broadcast['last_telegram_id'] = recipients[-1]['telegram_id']
+        database.record_broadcast_chunk(broadcast_id, results, broadcast['last_telegram_id'])
+
+def _fail(broadcast_id):
+    try:
+        database.finish_broadcast(broadcast_id, status="failed")
+        _report(broadcast_id)
+    except Exception as e:
+        # Still 'running' in the database, so it resumes on the next start
+        logger.error(f"Could not mark broadcast {broadcast_id} failed: {e}")
+
+def _report(broadcast_id):
+    broadcast = database.get_broadcast(broadcast_id)
+    if broadcast['created_by']:
+        sender.send_message(broadcast['created_by'], format_status(broadcast))
+
+def format_status(broadcast):
+    done = broadcast['sent'] + broadcast['failed']
+    remaining = max(0, broadcast['total'] - done)
+    end = broadcast['finished_at'] or datetime.now()
+    elapsed = max(1.0, (end - broadcast['created_at']).total_seconds())
+    audience = broadcast['audience']
+    if broadcast['audience_days'] is not None:
+        audience = f"{audience}:{broadcast['audience_days']}"
+    return (
+        f"Broadcast #{broadcast['id']} ({audience}) - {broadcast['status']}\n"
+        f"Sent: {broadcast['sent']}, Failed: {broadcast['failed']}, Remaining: {remaining}\n"
+        f"Throughput: {done / elapsed:.1f} msg/s"
+    )
@@ -0,0 +1,398 @@
+# conformance.py
+# Storage conformance checks: runs the database.py functions the bot relies on against the
+# configured backend and reports which behave differently. Point it at a scratch database;
+# it creates the schema and refuses to run if the users table already has rows.
+#
+#   python conformance.py --backend sqlite                  (temporary file database)
+#   DB_NAME=bot_scratch python conformance.py --backend mysql
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+import database
+import search
+import storage
+
+CHECKS = []
+
+def check(fn):
+    CHECKS.append(fn)
+    return fn
+
+def seed_users(ids, handshake=False):
+    for telegram_id in ids:
+        database.save_user(telegram_id, f"user{telegram_id}", telegram_id * 10, handshake=handshake)
+
+def pending_ids():
+    rows, _, _ = database.get_pending_payments_page(limit=1000)
+    return [row['telegram_id'] for row in rows]
+
+def count(sql, params=()):
+    with database.db_cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0]
+
+@check
+def schema_is_idempotent():
+    assert database.schema_version() == database.SCHEMA_VERSION
+    assert database.migrate() == 0
+    # A database from before versioning replays every step over its existing tables
+    with database.db_cursor() as cursor:
+        cursor.execute("DELETE FROM schema_version")
+    assert database.migrate() == len(database.MIGRATIONS)
+    assert database.schema_version() == database.SCHEMA_VERSION
+
+@check
+def fresh_schema_indexes():
+    # main() set up an empty database: every index must exist alongside its table
+    with database.db_cursor() as cursor:
+        for table, name in (("subscriptions", "idx_subscriptions_end_date"), ("subscriptions", "idx_subscriptions_pending"),
+                            ("users", "idx_users_username")):
+            assert database.backend.index_exists(cursor, table, name), name
+
+@check
+def users_round_trip():
+    database.save_user(101, "alpha", 1010)
+    database.clear_caches()
+    assert database.get_user(101) == {'telegram_id': 101, 'username': 'alpha', 'chat_id': 1010}
+    assert database.user_exists(101)
+    assert not database.user_exists(999999)
+    database.save_user(101, "alpha2", 1011)
+    database.clear_caches()
+    assert database.get_user(101)['username'] == "alpha2"
+
+@check
+def handshake_stamps():
+    database.save_user(102, "beta", 1020, handshake=True)
+    first = count("SELECT COUNT(*) FROM users WHERE telegram_id = %s AND first_handshake_at IS NOT NULL", (102,))
+    assert first == 1
+    database.save_user(102, "beta", 1020)
+    with database.db_cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT first_handshake_at, last_seen_at FROM users WHERE telegram_id = %s", (102,))
+        row = cursor.fetchone()
+    assert isinstance(row['first_handshake_at'], datetime), row
+    assert row['last_seen_at'] is not None
+    rows, _, _ = database.get_users_with_handshake_page(limit=1000)
+    ids = [u['telegram_id'] for u in rows]
+    assert 102 in ids and 101 not in ids
+
+@check
+def search_ranking_and_escaping():
+    database.save_user(103, "army_1", 1030)
+    database.save_user(104, "armyx1", 1040)
+    database.save_user(105, "my_army", 1050)
+    database.clear_caches()
+    names = [u['username'] for u in database.search_users("army_1")]
+    assert names == ["army_1"], names
+    ngram_search = database.NGRAM_SEARCH
+    try:
+        # Without the n-gram index only ID and username-prefix matches are returned
+        database.NGRAM_SEARCH = False
+        names = [u['username'] for u in database.search_users("army")]
+        assert names == ["army_1", "armyx1"], names
+        database.NGRAM_SEARCH = True
+        names = [u['username'] for u in database.search_users("army")]
+        assert names[:2] == ["army_1", "armyx1"] and "my_army" in names, names
+    finally:
+        database.NGRAM_SEARCH = ngram_search
+        database.search_index = search.NgramIndex()
+    assert [u['telegram_id'] for u in database.search_users("104")][0] == 104
+    assert database.search_users("100%") == []
+
+@check
+def keyset_paging():
+    seed_users(range(200, 225))
+    forward, after = [], None
+    while True:
+        rows, has_prev, has_next = database.get_users_page(after_id=after, limit=7)
+        forward.extend(r['telegram_id'] for r in rows)
+        assert has_prev == (after is not None)
+        if not has_next:
+            break
+        after = rows[-1]['telegram_id']
+    assert forward == sorted(forward) and set(range(200, 225)) <= set(forward)
+    rows, has_prev, has_next = database.get_users_page(before_id=210, limit=3)
+    assert [r['telegram_id'] for r in rows] == [207, 208, 209] and has_next
+    assert [u['telegram_id'] for u in database.iter_users(batch_size=4)] == forward
+
+@check
+def interactions_write():
+    database.log_interaction(101, "hello")
+    database.log_interaction(101, "again")
+    assert count("SELECT COUNT(*) FROM interactions WHERE telegram_id = %s", (101,)) == 2
+
+@check
+def interaction_retention():
+    old = datetime.now() - timedelta(days=100)
+    database.interaction_logger._write([
+        (101, "handshake", old), (101, "hello", old), (101, "hi", old + timedelta(days=1)), (102, "subscribe", old)
+    ])
+    assert database.retire_interactions(old + timedelta(hours=1), 2) == 2
+    assert database.retire_interactions(old + timedelta(days=2), 10) == 2
+    assert database.retire_interactions(old + timedelta(days=2), 10) == 0
+    assert count("SELECT COUNT(*) FROM interactions WHERE telegram_id = %s", (101,)) == 2
+    with database.db_cursor() as cursor:
+        cursor.execute("SELECT telegram_id, day, kind, events FROM interaction_daily ORDER BY telegram_id, day, kind")
+        rollup = cursor.fetchall()
+    assert rollup == [(101, old.date(), "handshake", 1), (101, old.date(), "message", 1),
+                      (101, old.date() + timedelta(days=1), "message", 1), (102, old.date(), "subscribe", 1)], rollup
+    assert count("SELECT COUNT(*) FROM interactions_archive") == 4
+    assert database.purge_interaction_archive(old + timedelta(hours=1), 10) == 3
+    assert count("SELECT COUNT(*) FROM interactions_archive") == 1
+
+@check
+def subscriptions_and_payments():
+    today = datetime.now().date()
+    database.save_subscription(101, today, today + timedelta(days=30))
+    database.save_subscription(102, today, today + timedelta(days=2))
+    database.clear_caches()
+    assert not database.has_paid(101)
+    pending = pending_ids()
+    assert pending == [101, 102], pending
+    rows, _, has_next = database.get_pending_payments_page(limit=1)
+    assert [r['telegram_id'] for r in rows] == [101] and has_next
+    database.confirm_payment(101)
+    assert database.has_paid(101)
+    database.clear_caches()
+    assert database.has_paid(101)
+    assert pending_ids() == [102]
+    with database.db_cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT end_date, status FROM subscriptions WHERE telegram_id = %s", (101,))
+        assert cursor.fetchone() == {'end_date': today + timedelta(days=30), 'status': "active"}
+
+@check
+def reminders_ledger():
+    today = datetime.now().date()
+    due = {r['telegram_id']: r for r in database.get_due_reminders(today, 3, 7)}
+    assert 102 in due and 101 not in due and due[102]['reminded_threshold'] is None
+    database.record_reminders([(102, due[102]['end_date'], 3)])
+    database.record_reminders([(102, due[102]['end_date'], 3)])
+    due = {r['telegram_id']: r for r in database.get_due_reminders(today, 3, 7)}
+    assert due[102]['reminded_threshold'] == 3
+
+@check
+def command_scopes():
+    assert database.get_command_scope_version(101) is None
+    database.save_command_scope(101, "user", "v1")
+    database.save_command_scope(101, "admin", "v2")
+    database.clear_caches()
+    assert database.get_command_scope_version(101) == "v2"
+
+@check
+def conversation_state():
+    assert database.get_conversation_state("user", 101) is None
+    database.save_conversation_states([("user", 101, '{"help_mode": true}'), ("chat", 101, '{"a": 1}')])
+    database.save_conversation_states([("user", 101, '{"chat_with": 5}'), ("chat", 101, None)])
+    assert database.get_conversation_state("user", 101) == '{"chat_with": 5}'
+    assert database.get_conversation_state("chat", 101) is None
+
+@check
+def broadcasts_ledger():
+    broadcast_id = database.create_broadcast("hi", "handshake", None, 101)
+    broadcast = database.get_broadcast(broadcast_id)
+    assert broadcast['total'] == 1 and broadcast['status'] == "running"
+    assert isinstance(broadcast['created_at'], datetime)
+    # Stamped in local time, like finished_at, so elapsed time is right off UTC too
+    assert abs((datetime.now() - broadcast['created_at']).total_seconds()) < 60
+    assert broadcast_id in [b['id'] for b in database.get_running_broadcasts()]
+    recipients = database.get_broadcast_recipients(broadcast, 10)
+    assert [r['telegram_id'] for r in recipients] == [102]
+    database.claim_broadcast_recipients(broadcast_id, [102])
+    assert database.get_broadcast_recipients(broadcast, 10) == []
+    database.record_broadcast_chunk(broadcast_id, [(102, "sent", None)], 102)
+    database.abandon_pending_deliveries(broadcast_id)
+    database.finish_broadcast(broadcast_id)
+    broadcast = database.get_broadcast(broadcast_id)
+    assert (broadcast['sent'], broadcast['failed'], broadcast['status']) == (1, 0, "done")
+    assert database.get_recent_broadcasts(1)[0]['id'] == broadcast_id
+    paid_id = database.create_broadcast("paid", "paid", None, 101)
+    assert database.get_broadcast(paid_id)['total'] == 1
+    database.finish_broadcast(paid_id)
+
+@check
+def daily_counters():
+    today = datetime.now().date()
+    database.counters.incr("messages", 3)
+    database.counters.incr("messages", 2)
+    counts = database.get_daily_counters(today)
+    assert counts[today]["messages"] >= 5 and counts[today]["confirmations"] == 1, counts
+    # Rebuilt from raw data: the conformance run logged two messages today, confirmed one
+    # payment, and retention rolled up a start, two messages and a subscribe 100 days ago
+    database.rebuild_daily_counters()
+    counts = database.get_daily_counters(today - timedelta(days=101))
+    old = today - timedelta(days=100)
+    assert counts[today]["messages"] == 2 and counts[today]["confirmations"] == 1, counts[today]
+    assert counts[today]["registrations"] == count("SELECT COUNT(*) FROM users WHERE first_handshake_at IS NOT NULL")
+    assert counts[old] == {"starts": 1, "messages": 1, "subscriptions": 1}, counts[old]
+    assert counts[old + timedelta(days=1)] == {"messages": 1}
+
+@check
+def bulk_confirmation():
+    today = datetime.now().date()
+    for telegram_id in (103, 104, 105):
+        database.save_subscription(telegram_id, today, today + timedelta(days=30))
+    confirmed = database.confirm_payments([103, 104, 104, 101, 999])
+    assert sorted((r['telegram_id'], r['chat_id']) for r in confirmed) == [(103, 1030), (104, 1040)], confirmed
+    assert database.confirm_payments([103, 104]) == []
+    database.clear_caches()
+    assert database.has_paid(104) and not database.has_paid(105)
+    assert pending_ids() == [102, 105]
+
+@check
+def subscription_expiry():
+    today = datetime.now().date()
+    for telegram_id in (201, 202, 203):
+        database.save_subscription(telegram_id, today - timedelta(days=30), today - timedelta(days=1))
+    database.save_subscription(204, today - timedelta(days=30), today)
+    database.confirm_payments([201, 202, 204])
+    assert database.has_paid(201)
+    first = database.expire_subscriptions(today, 1)
+    assert [(r['telegram_id'], r['chat_id']) for r in first] == [(201, 2010)], first
+    assert [r['telegram_id'] for r in database.expire_subscriptions(today, 10)] == [202]
+    assert database.expire_subscriptions(today, 10) == []
+    assert not database.has_paid(201)
+    database.clear_caches()
+    assert not database.has_paid(202) and not database.has_paid(203) and database.has_paid(204)
+    events = [(e['from_status'], e['to_status']) for e in database.get_subscription_events(201)]
+    assert events == [("active", "expired"), ("pending", "active"), (None, "pending")], events
+    # Renewing starts over as pending
+    database.save_subscription(201, today, today + timedelta(days=30))
+    assert database.get_subscription_events(201, 1)[0]['from_status'] == "expired"
+    assert pending_ids() == [102, 105, 201, 203]
+
+@check
+def cache_warm_up():
+    database.clear_caches()
+    database.save_user(206, "gamma", 2060, handshake=True)
+    database.clear_caches()
+    assert database.warm_caches([101, 999], recent=1) == 2
+    assert database.entitlements.get(101)[0] and not database.entitlements.get(206)[0]
+    with database._user_cache_lock:
+        assert database._user_cache[206]['chat_id'] == 2060 and 999 not in database._user_cache
+
+@check
+def help_tickets():
+    ticket_id = database.create_ticket(101, "help me")
+    other_id = database.create_ticket(102, "me too")
+    database.record_ticket_attempt(ticket_id)
+    database.record_ticket_attempt(other_id)
+    database.mark_ticket_delivered(ticket_id)
+    later = datetime.now() + timedelta(minutes=1)
+    assert [t['id'] for t in database.get_undelivered_tickets(5, later)] == [other_id]
+    assert database.get_undelivered_tickets(5, datetime.now() - timedelta(minutes=1)) == []
+    assert database.get_undelivered_tickets(1, later) == []
+    assert database.claim_ticket(ticket_id, 7) and not database.claim_ticket(ticket_id, 8)
+    ticket = database.get_ticket(ticket_id)
+    assert (ticket['status'], ticket['claimed_by'], ticket['chat_id']) == ("claimed", 7, 1011), ticket
+    assert [t['id'] for t in database.get_open_tickets()] == [ticket_id, other_id]
+    assert database.answer_ticket(ticket_id) and not database.answer_ticket(ticket_id)
+    assert [t['id'] for t in database.get_open_tickets()] == [other_id]
+
+@check
+def streaming_export():
+    out = io.StringIO()
+    rows = database.export_rows("subscriptions", out, "csv", chunk_size=2)
+    lines = out.getvalue().splitlines()
+    assert rows == count("SELECT COUNT(*) FROM subscriptions") == len(lines) - 1
+    assert lines[0].startswith("telegram_id,username,start_date") and lines[1].startswith("101,alpha2,")
+    out = io.StringIO()
+    assert database.export_rows("users", out, "jsonl", chunk_size=3) == count("SELECT COUNT(*) FROM users")
+    first = json.loads(out.getvalue().splitlines()[0])
+    assert first['telegram_id'] == 101 and first['chat_id'] == 1011, first
+    path = os.path.join(tempfile.mkdtemp(), "interactions.csv.gz")
+    assert database.export_file("interactions", "csv", path) == count("SELECT COUNT(*) FROM interactions")
+    with gzip.open(path, "rt") as f:
+        assert f.readline().strip() == "id,telegram_id,message,timestamp"
+
+class SlowReadyIndex(search.NgramIndex):
+    # Widens the moment a build marks itself ready, so a racing save has time to land
+    @property
+    def ready(self):
+        return self._ready
+
+    @ready.setter
+    def ready(self, value):
+        if value:
+            time.sleep(0.2)
+        self._ready = value
+
+@check
+def search_index_build_races():
+    # One save while the table is being scanned, and one that commits while the build is
+    # wrapping up and must not fall between the replay and the index going ready
+    original_iter, original_index = database.iter_users, database._index_user
+    saver = threading.Thread(target=database.save_user, args=(208, "late_joiner", 2080))
+
+    def scanning(*args, **kwargs):
+        for user in original_iter(*args, **kwargs):
+            if user['telegram_id'] == 205:
+                database.save_user(207, "mid_scan", 2070)
+            yield user
+
+    def replaying(user):
+        if saver.ident is None:
+            saver.start()
+            while not count("SELECT COUNT(*) FROM users WHERE telegram_id = %s", (208,)):
+                time.sleep(0.01)
+        original_index(user)
+
+    database.search_index = SlowReadyIndex()
+    database.iter_users, database._index_user = scanning, replaying
+    try:
+        database.build_search_index()
+    finally:
+        database.iter_users, database._index_user = original_iter, original_index
+    saver.join()
+    try:
+        assert database.search_index.ready
+        assert [u['telegram_id'] for u in database.search_index.search("mid_scan", 5)] == [207]
+        assert [u['telegram_id'] for u in database.search_index.search("late_joiner", 5)] == [208]
+    finally:
+        database.search_index = search.NgramIndex()
+
+@check
+def transactions_roll_back():
+    try:
+        with database.db_cursor(transaction=True) as cursor:
+            cursor.execute("UPDATE users SET username = %s WHERE telegram_id = %s", ("rolled", 101))
+            raise RuntimeError("abort")
+    except RuntimeError:
+        pass
+    assert count("SELECT COUNT(*) FROM users WHERE username = %s", ("rolled",)) == 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the storage conformance checks")
+    parser.add_argument("--backend", default=os.getenv("DB_BACKEND", "mysql"), help="mysql or sqlite")
+    parser.add_argument("--path", help="SQLite database file (default: a temporary file)")
+    args = parser.parse_args()
+
+    if args.backend == "sqlite" and not args.path:
+        args.path = os.path.join(tempfile.mkdtemp(), "conformance.db")
+    if args.path:
+        os.environ["SQLITE_PATH"] = args.path
+    database.backend = storage.create_backend(args.backend)
+    database.setup_database()
+    if count("SELECT COUNT(*) FROM users"):
+        sys.exit(f"{database.backend.describe()} is not empty; point the checks at a scratch database")
+
+    failures = 0
+    for fn in CHECKS:
+        try:
+            fn()
+            print(f"ok    {fn.__name__}")
+        except Exception:
+            failures += 1
+            print(f"FAIL  {fn.__name__}")
+            traceback.print_exc()
+    print(f"{len(CHECKS) - failures}/{len(CHECKS)} checks passed on {database.backend.describe()}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,163 @@
 # database.py
-import mysql.connector
+import argparse
+import csv
+import gzip
+import json
+import logging
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from cachetools import LRUCache, TTLCache
 from datetime import datetime, timedelta
+from search import NgramIndex
+import metrics
+import storage
 
-def get_db_connection():
-    host = os.getenv("DB_HOST") or "mysql.railway.internal"
-    port = int(os.getenv("DB_PORT", 3306))
-    user = os.getenv("DB_USER") or "root"
-    password = os.getenv("DB_PASSWORD") or "qItgFGuqsyxICAvhiBitaijtiQZuujAD"
-    database = os.getenv("DB_NAME") or "railway"
-    print(f"DB_HOST: {host}")
-    print(f"DB_PORT: {port}")
-    print(f"DB_USER: {user}")
-    print(f"DB_PASSWORD: {password}")
-    print(f"DB_NAME: {database}")
-    return mysql.connector.connect(
-        host=host,
-        port=port,
-        user=user,
-        password=password,
-        database=database
-    )
+logger = logging.getLogger(__name__)
 
-def setup_database():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+# Storage backend chosen by DB_BACKEND; every query below runs unchanged on either
+backend = storage.create_backend()
+
+def init_pool(size=None):
+    return backend.init(size)
+
+def db_connection():
+    return backend.connection()
+
+def pool_stats():
+    return backend.stats()
+
+@contextmanager
+def db_cursor(dictionary=False, transaction=False):
+    with db_connection() as conn:
+        if transaction:
+            conn.start_transaction()
+        cursor = conn.cursor(dictionary=dictionary)
+        try:
+            yield cursor
+            if transaction:
+                conn.commit()
+        except Exception:
+            if transaction:
+                conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+# Bounded directory of users keyed by telegram_id. Missing users are cached as None
+# so repeated user_exists() checks for unregistered senders stay off the database too.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 600))
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
+_MISSING = object()
+
+def _cache_user(telegram_id, user):
+    with _user_cache_lock:
+        _user_cache[telegram_id] = user
+
+class EntitlementCache:
+    # Paid status per telegram_id. Entries live for at most `ttl` seconds and never
+    # past the end of the subscription's end_date, so a lapsed plan is re-read.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id):
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry[2] <= time.time():
+                if entry is not None:
+                    del self._entries[telegram_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, telegram_id, paid, end_date):
+        expires_at = time.time() + self.ttl
+        if end_date is not None:
+            day_after = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+            expires_at = min(expires_at, day_after.timestamp())
+        with self._lock:
+            self._entries[telegram_id] = (paid, end_date, expires_at)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+entitlements = EntitlementCache(
+    maxsize=int(os.getenv("ENTITLEMENT_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("ENTITLEMENT_CACHE_TTL", 3600))
+)
+
+def _create_index(cursor, name, table, columns):
+    backend.create_index(cursor, name, table, columns)
+
+def _column_exists(cursor, table, column):
+    return backend.column_exists(cursor, table, column)
+
+def _migrate_handshake_columns(cursor):
+    # Handshake state lives on the user row; backfill it once from the interaction history
+    if _column_exists(cursor, "users", "first_handshake_at"):
+        return
+    cursor.execute("ALTER TABLE users ADD COLUMN first_handshake_at DATETIME NULL, ADD COLUMN last_seen_at DATETIME NULL")
+    cursor.execute("""
+        UPDATE users u
+        JOIN (
+            SELECT telegram_id, MIN(timestamp) AS first_at, MAX(timestamp) AS last_at
+            FROM interactions
+            WHERE message = 'handshake'
+            GROUP BY telegram_id
+        ) h ON h.telegram_id = u.telegram_id
+        SET u.first_handshake_at = h.first_at, u.last_seen_at = h.last_at
+    """)
+    logger.info(f"Backfilled handshake state for {cursor.rowcount} users")
+
+def _migrate_subscription_status(cursor):
+    # Entitlement is read from status; derive it once from payment_confirmed and end_date
+    if _column_exists(cursor, "subscriptions", "status"):
+        return
+    cursor.execute("ALTER TABLE subscriptions ADD COLUMN status VARCHAR(16) NOT NULL DEFAULT 'pending'")
+    cursor.execute("""
+        UPDATE subscriptions SET status = CASE
+            WHEN payment_confirmed = FALSE THEN 'pending'
+            WHEN end_date < %s THEN 'expired'
+            ELSE 'active'
+        END
+    """, (datetime.now().date(),))
+    logger.info(f"Backfilled subscription status for {cursor.rowcount} subscriptions")
+
+def _migration_tables(cursor):
+    # Every table at its current shape; later steps bring tables from older deployments up to it
     # Create users table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             telegram_id BIGINT PRIMARY KEY,
             username VARCHAR(255),
-            chat_id BIGINT
+            chat_id BIGINT,
+            first_handshake_at DATETIME NULL,
+            last_seen_at DATETIME NULL
         )
     """)
     # Create interactions table
@@ -43,6 +170,44 @@ def setup_database():
             FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
         )
     """)
+    # Create interactions_archive table, where retention moves raw rows past the live horizon
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS interactions_archive (
+            id BIGINT PRIMARY KEY,
+            telegram_id BIGINT,
+            message TEXT,
+            timestamp TIMESTAMP NULL
+        )
+    """)
+    # Create interaction_daily table with per-user, per-day counts of retired interactions
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS interaction_daily (
+            telegram_id BIGINT,
+            day DATE,
+            kind VARCHAR(16),
+            events INT DEFAULT 0,
+            PRIMARY KEY (telegram_id, day, kind)
+        )
+    """)
+    # Create reminders_sent ledger so each subscription is reminded once per threshold
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reminders_sent (
+            telegram_id BIGINT,
+            end_date DATE,
+            threshold INT,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, end_date, threshold)
+        )
+    """)
+    # Create command_scopes table recording the command set applied to each chat
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS command_scopes (
+            chat_id BIGINT PRIMARY KEY,
+            role VARCHAR(16),
+            version VARCHAR(64),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """)
     # Create subscriptions table with payment_confirmed column
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS subscriptions (
@@ -50,125 +215,1061 @@ def setup_database():
             start_date DATE,
             end_date DATE,
             payment_confirmed BOOLEAN DEFAULT FALSE,
+            confirmed_at DATETIME NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
             FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
         )
     """)
-    conn.commit()
-    cursor.close()
-    conn.close()
+    # Create subscription_events table, one row per status change
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscription_events (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            telegram_id BIGINT,
+            from_status VARCHAR(16),
+            to_status VARCHAR(16),
+            end_date DATE,
+            created_at DATETIME
+        )
+    """)
+    # Create broadcasts table; last_telegram_id is the keyset checkpoint for resuming
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            message TEXT,
+            audience VARCHAR(32),
+            audience_days INT,
+            created_by BIGINT,
+            status VARCHAR(16) DEFAULT 'running',
+            total INT DEFAULT 0,
+            sent INT DEFAULT 0,
+            failed INT DEFAULT 0,
+            last_telegram_id BIGINT DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP NULL
+        )
+    """)
+    # Create broadcast_deliveries table, the per-recipient ledger that prevents double sends
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INT,
+            telegram_id BIGINT,
+            status VARCHAR(16),
+            error VARCHAR(255),
+            PRIMARY KEY (broadcast_id, telegram_id),
+            FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id)
+        )
+    """)
+    # Create daily_counters table, incremented as events happen and read by the /stats dashboard
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_counters (
+            day DATE,
+            metric VARCHAR(32),
+            value BIGINT DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        )
+    """)
+    # Create conversation_state table holding the dispatcher's user_data/chat_data as JSON
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            kind VARCHAR(8),
+            state_key BIGINT,
+            data TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, state_key)
+        )
+    """)
 
-def save_user(telegram_id, username, chat_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _migration_subscription_status(cursor):
+    if not _column_exists(cursor, "subscriptions", "confirmed_at"):
+        cursor.execute("ALTER TABLE subscriptions ADD COLUMN confirmed_at DATETIME NULL")
+    _migrate_subscription_status(cursor)
+
+def _migration_indexes(cursor):
+    # Secondary indexes for the lookups, listings and background jobs that filter on these columns
+    _create_index(cursor, "idx_users_username", "users", "username")
+    _create_index(cursor, "idx_users_first_handshake", "users", "first_handshake_at")
+    _create_index(cursor, "idx_users_last_seen", "users", "last_seen_at")
+    _create_index(cursor, "idx_interactions_timestamp", "interactions", "timestamp")
+    _create_index(cursor, "idx_interactions_archive_timestamp", "interactions_archive", "timestamp")
+    _create_index(cursor, "idx_interaction_daily_day", "interaction_daily", "day")
+    _create_index(cursor, "idx_subscriptions_end_date", "subscriptions", "end_date")
+    # Pending-payment listings filter on payment_confirmed and walk telegram_id
+    _create_index(cursor, "idx_subscriptions_pending", "subscriptions", "payment_confirmed, telegram_id")
+    # The expiry sweeper finds active subscriptions past their end_date
+    _create_index(cursor, "idx_subscriptions_status_end", "subscriptions", "status, end_date")
+    _create_index(cursor, "idx_subscription_events_user", "subscription_events", "telegram_id, id")
+
+def _migration_help_tickets(cursor):
+    # Help requests, fanned out to the admins and claimed by one of them through /chat
     cursor.execute("""
-        INSERT INTO users (telegram_id, username, chat_id)
-        VALUES (%s, %s, %s)
-        ON DUPLICATE KEY UPDATE username = %s, chat_id = %s
-    """, (telegram_id, username, chat_id, username, chat_id))
-    conn.commit()
-    cursor.close()
-    conn.close()
+        CREATE TABLE IF NOT EXISTS help_tickets (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            telegram_id BIGINT,
+            message TEXT,
+            status VARCHAR(16) DEFAULT 'open',
+            claimed_by BIGINT NULL,
+            attempts INT DEFAULT 0,
+            created_at DATETIME,
+            last_attempt_at DATETIME NULL,
+            delivered_at DATETIME NULL,
+            claimed_at DATETIME NULL,
+            answered_at DATETIME NULL
+        )
+    """)
+    _create_index(cursor, "idx_help_tickets_status", "help_tickets", "status, id")
+
+# Forward-only schema migrations as (version, description, step). Append new steps and
+# never change one that has shipped. Databases created before versioning start at 0 and
+# replay every step, so each one must tolerate finding its work already done.
+MIGRATIONS = [
+    (1, "base tables", _migration_tables),
+    (2, "handshake state on users", _migrate_handshake_columns),
+    (3, "subscription confirmation time and status", _migration_subscription_status),
+    (4, "secondary indexes", _migration_indexes),
+    (5, "help tickets", _migration_help_tickets),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version():
+    with db_cursor() as cursor:
+        if not backend.table_exists(cursor, "schema_version"):
+            return 0
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        return cursor.fetchone()[0] or 0
+
+def migrate():
+    # Applies the migrations newer than the database's version; returns how many ran.
+    # An up-to-date database costs one version read and no DDL.
+    current = schema_version()
+    if current > SCHEMA_VERSION:
+        logger.warning(f"Database schema version {current} is newer than this code ({SCHEMA_VERSION})")
+    pending = [migration for migration in MIGRATIONS if migration[0] > current]
+    if not pending:
+        return 0
+    with db_cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                description VARCHAR(255),
+                applied_at DATETIME
+            )
+        """)
+        for version, description, step in pending:
+            logger.info(f"Applying schema migration {version}: {description}")
+            step(cursor)
+            # Two processes migrating at once both replay the same idempotent steps
+            cursor.execute(
+                "INSERT IGNORE INTO schema_version (version, description, applied_at) VALUES (%s, %s, %s)",
+                (version, description, datetime.now())
+            )
+    logger.info(f"Database schema at version {SCHEMA_VERSION} ({len(pending)} migrations applied)")
+    return len(pending)
+
+def setup_database():
+    return migrate()
+
+CACHE_WARMUP_USERS = int(os.getenv("CACHE_WARMUP_USERS", 0))  # 0 disables the startup warm-up
+
+def warm_caches(telegram_ids=(), recent=None):
+    # Preloads the user and entitlement caches for telegram_ids (e.g. the admins) and the
+    # `recent` most recently seen users, so the first updates after a deploy skip the database.
+    # Returns the number of users loaded.
+    recent = CACHE_WARMUP_USERS if recent is None else recent
+    select = """
+        SELECT u.telegram_id, u.username, u.chat_id, s.status, s.end_date
+        FROM users u
+        LEFT JOIN subscriptions s ON s.telegram_id = u.telegram_id
+    """
+    rows = []
+    with db_cursor(dictionary=True) as cursor:
+        if telegram_ids:
+            cursor.execute(f"{select} WHERE u.telegram_id IN ({', '.join(['%s'] * len(telegram_ids))})",
+                           list(telegram_ids))
+            rows.extend(cursor.fetchall())
+        if recent > 0:
+            cursor.execute(f"{select} WHERE u.last_seen_at IS NOT NULL ORDER BY u.last_seen_at DESC LIMIT %s",
+                           (recent,))
+            rows.extend(cursor.fetchall())
+    for row in rows:
+        _cache_user(row['telegram_id'], {key: row[key] for key in ('telegram_id', 'username', 'chat_id')})
+        paid = row['status'] == "active"
+        entitlements.put(row['telegram_id'], paid, row['end_date'] if paid else None)
+    return len({row['telegram_id'] for row in rows})
+
+def save_user(telegram_id, username, chat_id, handshake=False):
+    # A handshake stamps last_seen_at, and first_handshake_at the first time only
+    seen_at = datetime.now() if handshake else None
+    # A registration is the first save of an id; the lookup is usually answered by the cache
+    with _user_cache_lock:
+        known = _user_cache.get(telegram_id, _MISSING)
+    if known is _MISSING:
+        known = get_user(telegram_id)
+    with db_cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO users (telegram_id, username, chat_id, first_handshake_at, last_seen_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE username = VALUES(username), chat_id = VALUES(chat_id),
+                first_handshake_at = COALESCE(first_handshake_at, VALUES(first_handshake_at)),
+                last_seen_at = COALESCE(VALUES(last_seen_at), last_seen_at)
+        """, (telegram_id, username, chat_id, seen_at, seen_at))
+    if known is None:
+        counters.incr("registrations")
+    user = {'telegram_id': telegram_id, 'username': username, 'chat_id': chat_id}
+    _cache_user(telegram_id, user)
+    _index_saved_user(user)
+
+# Optional substring index over usernames and IDs, kept current by save_user()
+SEARCH_LIMIT = int(os.getenv("USER_SEARCH_LIMIT", 20))
+NGRAM_SEARCH = os.getenv("USER_SEARCH_NGRAM", "0") == "1"
+search_index = NgramIndex()
+_search_index_lock = threading.Lock()
+# Users saved while a build is reading the table, replayed before the index is marked ready
+_search_index_pending = None
+_search_index_pending_lock = threading.Lock()
+
+def _index_user(user):
+    search_index.add(user['telegram_id'], (user['username'], str(user['telegram_id'])), dict(user))
+
+def _index_saved_user(user):
+    # Called after the row is committed, so a build that starts later reads it from the table
+    with _search_index_pending_lock:
+        if _search_index_pending is not None:
+            _search_index_pending[user['telegram_id']] = user
+        elif search_index.ready:
+            _index_user(user)
+
+def build_search_index():
+    global _search_index_pending
+    with _search_index_lock:
+        if search_index.ready:
+            return
+        started = time.monotonic()
+        with _search_index_pending_lock:
+            _search_index_pending = {}
+        built = False
+        try:
+            search_index.build((u['telegram_id'], (u['username'], str(u['telegram_id'])), u) for u in iter_users())
+            built = True
+        finally:
+            with _search_index_pending_lock:
+                # Saves made mid-build win over the rows the scan may have read before them.
+                # ready flips under the same lock, so a save can't land between the two.
+                for user in _search_index_pending.values():
+                    _index_user(user)
+                search_index.ready = built
+                _search_index_pending = None
+        logger.info(f"User search index built: {len(search_index)} users in {time.monotonic() - started:.1f}s")
+
+def _escape_like(text):
+    # "!" is the escape character; MySQL and SQLite spell a backslash literal differently
+    return text.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+
+def search_users(text, limit=SEARCH_LIMIT):
+    # Ranked: exact ID, exact username, username prefix, then substring matches. The SQL
+    # lookups only use the primary key and the username index; substring matches come from
+    # the n-gram index (USER_SEARCH_NGRAM=1) and are skipped without it.
+    text = text.strip().lstrip("@").lower()
+    if not text:
+        return []
+    ranked = {}
+
+    def consider(user, rank):
+        if user and rank < ranked.get(user['telegram_id'], (99,))[0]:
+            ranked[user['telegram_id']] = (rank, user)
+
+    if text.isdigit():
+        consider(get_user(int(text)), 0)
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(
+            "SELECT telegram_id, username, chat_id FROM users WHERE username LIKE %s ESCAPE '!' ORDER BY username LIMIT %s",
+            (_escape_like(text) + "%", limit)
+        )
+        for user in cursor.fetchall():
+            consider(user, 1 if user['username'].lower() == text else 2)
+
+    if len(ranked) < limit and NGRAM_SEARCH:
+        if not search_index.ready:
+            build_search_index()
+        # None when the query is shorter than an n-gram
+        for user in search_index.search(text, limit * 5) or []:
+            consider(user, 3)
+
+    results = sorted(ranked.values(), key=lambda r: (r[0], len(r[1]['username'] or ""), r[1]['telegram_id']))
+    return [user for _, user in results[:limit]]
+
+def get_user(telegram_id):
+    with _user_cache_lock:
+        user = _user_cache.get(telegram_id, _MISSING)
+    if user is _MISSING:
+        with db_cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT telegram_id, username, chat_id FROM users WHERE telegram_id = %s", (telegram_id,))
+            user = cursor.fetchone()
+        _cache_user(telegram_id, user)
+    return dict(user) if user else None
 
 def user_exists(telegram_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = %s", (telegram_id,))
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return result is not None
+    return get_user(telegram_id) is not None
+
+class InteractionLogger:
+    # Write-behind logger: handlers enqueue events and a background thread
+    # writes them with multi-row inserts once batch_size or flush_interval is hit.
+    def __init__(self, max_queue, batch_size, flush_interval, enqueue_timeout):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'logged': 0, 'flushed': 0, 'batches': 0, 'dropped': 0, 'failed': 0,
+                       'last_flush_ms': 0.0, 'max_flush_ms': 0.0}
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="interaction-logger", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        # Drain whatever is queued before returning
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def log(self, telegram_id, message):
+        event = (telegram_id, message, datetime.now())
+        if self._thread is None:
+            self._write([event])
+            return
+        try:
+            # Backpressure: a full queue holds the handler until the flusher catches up
+            self._queue.put(event, timeout=self.enqueue_timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+            logger.warning(f"Interaction queue full, dropped event for {telegram_id}")
+            return
+        with self._lock:
+            self._stats['logged'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, queue_depth=self._queue.qsize())
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (self._stop.is_set() and self._queue.empty()):
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=min(remaining, 0.5)))
+                except queue.Empty:
+                    continue
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            self._write(batch)
+        except Exception as e:
+            with self._lock:
+                self._stats['failed'] += len(batch)
+            logger.error(f"Failed to write {len(batch)} interactions: {e}")
+            return
+        elapsed = (time.monotonic() - started) * 1000
+        with self._lock:
+            self._stats['flushed'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['last_flush_ms'] = elapsed
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed)
+
+    def _write(self, events):
+        with db_cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO interactions (telegram_id, message, timestamp) VALUES (%s, %s, %s)",
+                events
+            )
+
+interaction_logger = InteractionLogger(
+    max_queue=int(os.getenv("INTERACTION_QUEUE_SIZE", 10000)),
+    batch_size=int(os.getenv("INTERACTION_BATCH_SIZE", 200)),
+    flush_interval=float(os.getenv("INTERACTION_FLUSH_INTERVAL", 2.0)),
+    enqueue_timeout=float(os.getenv("INTERACTION_ENQUEUE_TIMEOUT", 1.0))
+)
 
 def log_interaction(telegram_id, message):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO interactions (telegram_id, message) VALUES (%s, %s)", (telegram_id, message))
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-def get_all_users():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT telegram_id, username, chat_id FROM users")
-    users = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return users
-
-def get_users_with_handshake():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT DISTINCT u.telegram_id, u.username, u.chat_id
-        FROM users u
-        JOIN interactions i ON u.telegram_id = i.telegram_id
-        WHERE i.message = 'handshake'
-    """)
-    users = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return users
+    interaction_logger.log(telegram_id, message)
+    metric = INTERACTION_COUNTERS.get(interaction_kind(message))
+    if metric:
+        counters.incr(metric)
+
+INTERACTION_KINDS = ("handshake", "subscribe")
+# Daily counter fed by each interaction kind; subscribes are counted by save_subscription
+INTERACTION_COUNTERS = {"handshake": "starts", "message": "messages"}
+
+def interaction_kind(message):
+    # Rollups keep the fixed event names and count everything else as a free-text message
+    return message if message in INTERACTION_KINDS else "message"
+
+def retire_interactions(before, batch_size, archive=True):
+    # Moves one batch of interactions older than `before` out of the live table: the rows
+    # are counted into interaction_daily, copied to the archive if requested, and deleted,
+    # all in one short transaction. Returns the number of rows retired.
+    with db_cursor(transaction=True) as cursor:
+        cursor.execute("""
+            SELECT id, telegram_id, message, timestamp FROM interactions
+            WHERE timestamp < %s
+            ORDER BY timestamp
+            LIMIT %s
+        """, (before, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        counts = {}
+        for _, telegram_id, message, timestamp in rows:
+            key = (telegram_id, timestamp.date(), interaction_kind(message))
+            counts[key] = counts.get(key, 0) + 1
+        cursor.executemany("""
+            INSERT INTO interaction_daily (telegram_id, day, kind, events)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE events = events + VALUES(events)
+        """, [(*key, events) for key, events in counts.items()])
+        if archive:
+            cursor.executemany(
+                "INSERT IGNORE INTO interactions_archive (id, telegram_id, message, timestamp) VALUES (%s, %s, %s, %s)",
+                rows
+            )
+        ids = [row[0] for row in rows]
+        cursor.execute(f"DELETE FROM interactions WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        return len(rows)
+
+def purge_interaction_archive(before, batch_size):
+    # Drops one batch of archived rows older than `before`; returns how many went
+    with db_cursor(transaction=True) as cursor:
+        cursor.execute(
+            "SELECT id FROM interactions_archive WHERE timestamp < %s ORDER BY timestamp LIMIT %s",
+            (before, batch_size)
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+        if ids:
+            cursor.execute(f"DELETE FROM interactions_archive WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        return len(ids)
+
+COUNTER_METRICS = ("registrations", "starts", "messages", "subscriptions", "confirmations", "expirations")
+
+class DailyCounters:
+    # Per-day event counts. Increments accumulate in memory and a background thread adds
+    # them to daily_counters with one upsert batch every flush_interval seconds.
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}  # (day, metric) -> count not yet written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="daily-counters", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def incr(self, metric, amount=1, day=None):
+        key = (day or datetime.now().date(), metric)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+        if self._thread is None:
+            self.flush()
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                with db_cursor() as cursor:
+                    cursor.executemany("""
+                        INSERT INTO daily_counters (day, metric, value)
+                        VALUES (%s, %s, %s)
+                        ON DUPLICATE KEY UPDATE value = value + VALUES(value)
+                    """, [(day, metric, value) for (day, metric), value in pending.items()])
+            except Exception as e:
+                # Keep the counts for the next flush rather than losing them
+                with self._lock:
+                    for key, value in pending.items():
+                        self._pending[key] = self._pending.get(key, 0) + value
+                logger.error(f"Failed to write daily counters: {e}")
+
+counters = DailyCounters(flush_interval=float(os.getenv("COUNTER_FLUSH_INTERVAL", 5)))
+
+def _as_date(value):
+    # DATE() results come back as dates from MySQL and as ISO strings from SQLite
+    return datetime.strptime(value, "%Y-%m-%d").date() if isinstance(value, str) else value
+
+def get_daily_counters(since):
+    # {day: {metric: value}} from `since` to today, including increments not yet flushed
+    days = {}
+    with db_cursor() as cursor:
+        cursor.execute("SELECT day, metric, value FROM daily_counters WHERE day >= %s", (since,))
+        for day, metric, value in cursor.fetchall():
+            days.setdefault(day, {})[metric] = value
+    for (day, metric), value in counters.pending().items():
+        if day >= since:
+            bucket = days.setdefault(day, {})
+            bucket[metric] = bucket.get(metric, 0) + value
+    return days
+
+def rebuild_daily_counters():
+    # Recomputes every counter from the source tables. Registrations come from the first
+    # handshake, starts/messages/subscriptions from raw and rolled-up interactions, and
+    # confirmations from confirmed_at, expirations from subscription_events. Returns the number of (day, metric) rows written.
+    counters.flush()
+    totals = {}
+
+    def add(rows, metric=None):
+        for day, name, value in rows:
+            if metric or name:
+                key = (_as_date(day), metric or name)
+                totals[key] = totals.get(key, 0) + int(value)
+
+    kind_to_metric = "CASE {column} WHEN 'handshake' THEN 'starts' WHEN 'subscribe' THEN 'subscriptions' ELSE 'messages' END"
+    with db_cursor(transaction=True) as cursor:
+        cursor.execute("""
+            SELECT DATE(first_handshake_at), NULL, COUNT(*) FROM users
+            WHERE first_handshake_at IS NOT NULL GROUP BY DATE(first_handshake_at)
+        """)
+        add(cursor.fetchall(), "registrations")
+        cursor.execute(f"""
+            SELECT DATE(timestamp), {kind_to_metric.format(column="message")}, COUNT(*) FROM interactions
+            GROUP BY DATE(timestamp), {kind_to_metric.format(column="message")}
+        """)
+        add(cursor.fetchall())
+        cursor.execute(f"""
+            SELECT day, {kind_to_metric.format(column="kind")}, SUM(events) FROM interaction_daily
+            GROUP BY day, kind
+        """)
+        add(cursor.fetchall())
+        cursor.execute("""
+            SELECT DATE(confirmed_at), NULL, COUNT(*) FROM subscriptions
+            WHERE confirmed_at IS NOT NULL GROUP BY DATE(confirmed_at)
+        """)
+        add(cursor.fetchall(), "confirmations")
+        cursor.execute("""
+            SELECT DATE(created_at), NULL, COUNT(*) FROM subscription_events
+            WHERE to_status = 'expired' GROUP BY DATE(created_at)
+        """)
+        add(cursor.fetchall(), "expirations")
+        cursor.execute("DELETE FROM daily_counters")
+        cursor.executemany(
+            "INSERT INTO daily_counters (day, metric, value) VALUES (%s, %s, %s)",
+            [(day, metric, value) for (day, metric), value in totals.items()]
+        )
+    return len(totals)
+
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", 500))
+
+def _iter_keyset(query, params=(), key='telegram_id', batch_size=None):
+    # Pages through `query` by primary key. The query ends with "> %s ORDER BY ... LIMIT %s";
+    # a connection is only held while a page is fetched, not while rows are consumed.
+    batch_size = batch_size or DB_BATCH_SIZE
+    last = -(2 ** 63)
+    while True:
+        with db_cursor(dictionary=True) as cursor:
+            cursor.execute(query, (*params, last, batch_size))
+            rows = cursor.fetchall()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][key]
+
+def iter_users(batch_size=None):
+    return _iter_keyset(
+        "SELECT telegram_id, username, chat_id FROM users WHERE telegram_id > %s ORDER BY telegram_id LIMIT %s",
+        batch_size=batch_size
+    )
+
+def _keyset_page(select, where, key, params=(), after_id=None, before_id=None, limit=10):
+    # One LIMIT query per page, walking forwards from after_id or backwards from before_id.
+    # Returns (rows, has_prev, has_next).
+    if before_id is not None:
+        query = f"{select} WHERE {where} AND {key} < %s ORDER BY {key} DESC LIMIT %s"
+        cursor_id = before_id
+    else:
+        query = f"{select} WHERE {where} AND {key} > %s ORDER BY {key} LIMIT %s"
+        cursor_id = after_id if after_id is not None else -(2 ** 63)
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(query, (*params, cursor_id, limit + 1))
+        rows = cursor.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id is not None:
+        rows.reverse()
+        return rows, more, True
+    return rows, after_id is not None, more
+
+def get_users_page(after_id=None, before_id=None, limit=10):
+    return _keyset_page(
+        "SELECT telegram_id, username, chat_id FROM users", "TRUE", "telegram_id",
+        after_id=after_id, before_id=before_id, limit=limit
+    )
+
+def get_users_with_handshake_page(after_id=None, before_id=None, limit=50):
+    return _keyset_page(
+        "SELECT telegram_id, username, chat_id, first_handshake_at, last_seen_at FROM users",
+        "first_handshake_at IS NOT NULL", "telegram_id",
+        after_id=after_id, before_id=before_id, limit=limit
+    )
+
+def _record_subscription_events(cursor, events):
+    # events: list of (telegram_id, from_status, to_status, end_date)
+    now = datetime.now()
+    cursor.executemany("""
+        INSERT INTO subscription_events (telegram_id, from_status, to_status, end_date, created_at)
+        VALUES (%s, %s, %s, %s, %s)
+    """, [(*event, now) for event in events])
 
 def save_subscription(telegram_id, start_date, end_date):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO subscriptions (telegram_id, start_date, end_date, payment_confirmed)
-        VALUES (%s, %s, %s, FALSE)
-        ON DUPLICATE KEY UPDATE start_date = %s, end_date = %s, payment_confirmed = FALSE
-    """, (telegram_id, start_date, end_date, start_date, end_date))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with db_cursor(transaction=True) as cursor:
+        cursor.execute("SELECT status FROM subscriptions WHERE telegram_id = %s FOR UPDATE", (telegram_id,))
+        previous = cursor.fetchone()
+        cursor.execute("""
+            INSERT INTO subscriptions (telegram_id, start_date, end_date, payment_confirmed, status)
+            VALUES (%s, %s, %s, FALSE, 'pending')
+            ON DUPLICATE KEY UPDATE start_date = %s, end_date = %s, payment_confirmed = FALSE,
+                confirmed_at = NULL, status = 'pending'
+        """, (telegram_id, start_date, end_date, start_date, end_date))
+        _record_subscription_events(cursor, [(telegram_id, previous[0] if previous else None, "pending", end_date)])
+    entitlements.invalidate(telegram_id)
+    counters.incr("subscriptions")
+
+def confirm_payments(telegram_ids):
+    # Confirms every pending subscription among telegram_ids in one transaction and returns
+    # the ones that changed as [{telegram_id, chat_id, end_date}]. Already confirmed or
+    # unknown ids are skipped, so a repeated confirmation is a no-op.
+    telegram_ids = list(dict.fromkeys(telegram_ids))
+    if not telegram_ids:
+        return []
+    placeholders = ", ".join(["%s"] * len(telegram_ids))
+    with db_cursor(dictionary=True, transaction=True) as cursor:
+        cursor.execute(f"""
+            SELECT s.telegram_id, u.chat_id, s.end_date
+            FROM subscriptions s
+            JOIN users u ON u.telegram_id = s.telegram_id
+            WHERE s.telegram_id IN ({placeholders}) AND s.payment_confirmed = FALSE
+            FOR UPDATE
+        """, telegram_ids)
+        confirmed = cursor.fetchall()
+        if confirmed:
+            cursor.execute(f"""
+                UPDATE subscriptions SET payment_confirmed = TRUE, confirmed_at = %s, status = 'active'
+                WHERE telegram_id IN ({", ".join(["%s"] * len(confirmed))}) AND payment_confirmed = FALSE
+            """, (datetime.now(), *[row['telegram_id'] for row in confirmed]))
+            _record_subscription_events(cursor, [(row['telegram_id'], "pending", "active", row['end_date'])
+                                                 for row in confirmed])
+    for row in confirmed:
+        entitlements.put(row['telegram_id'], True, row['end_date'])
+    if confirmed:
+        counters.incr("confirmations", len(confirmed))
+    return confirmed
 
 def confirm_payment(telegram_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE subscriptions SET payment_confirmed = TRUE WHERE telegram_id = %s", (telegram_id,))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    return bool(confirm_payments([telegram_id]))
+
+def expire_subscriptions(today, batch_size):
+    # Moves up to batch_size active subscriptions that ended before `today` to expired and
+    # returns them as [{telegram_id, chat_id, end_date}]. Walks idx_subscriptions_status_end,
+    # so each batch only touches the rows it changes.
+    with db_cursor(dictionary=True, transaction=True) as cursor:
+        cursor.execute("""
+            SELECT s.telegram_id, u.chat_id, s.end_date
+            FROM subscriptions s
+            JOIN users u ON u.telegram_id = s.telegram_id
+            WHERE s.status = 'active' AND s.end_date < %s
+            ORDER BY s.end_date, s.telegram_id
+            LIMIT %s
+            FOR UPDATE
+        """, (today, batch_size))
+        expired = cursor.fetchall()
+        if expired:
+            cursor.execute(f"""
+                UPDATE subscriptions SET status = 'expired'
+                WHERE telegram_id IN ({", ".join(["%s"] * len(expired))}) AND status = 'active'
+            """, [row['telegram_id'] for row in expired])
+            _record_subscription_events(cursor, [(row['telegram_id'], "active", "expired", row['end_date'])
+                                                 for row in expired])
+    for row in expired:
+        entitlements.put(row['telegram_id'], False, None)
+    if expired:
+        counters.incr("expirations", len(expired))
+    return expired
 
 def has_paid(telegram_id):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT payment_confirmed FROM subscriptions WHERE telegram_id = %s", (telegram_id,))
-    result = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return result and result['payment_confirmed']
-
-def get_subscriptions():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT telegram_id, start_date, end_date, payment_confirmed FROM subscriptions")
-    subscriptions = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return subscriptions
-
-def get_pending_payments():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT s.telegram_id, u.username
+    # One primary-key read of the status the confirm and expiry paths maintain
+    cached = entitlements.get(telegram_id)
+    if cached is not None:
+        return cached[0]
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT status, end_date FROM subscriptions WHERE telegram_id = %s", (telegram_id,))
+        result = cursor.fetchone()
+    paid = bool(result and result['status'] == "active")
+    entitlements.put(telegram_id, paid, result['end_date'] if result and paid else None)
+    return paid
+
+def get_subscription_events(telegram_id, limit=20):
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute("""
+            SELECT from_status, to_status, end_date, created_at FROM subscription_events
+            WHERE telegram_id = %s ORDER BY id DESC LIMIT %s
+        """, (telegram_id, limit))
+        return cursor.fetchall()
+
+def get_due_reminders(today, window_days, grace_days):
+    # Subscriptions ending inside the window, with the subscriber's chat and the lowest
+    # threshold already reminded for that end_date (NULL when never reminded)
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute("""
+            SELECT s.telegram_id, s.end_date, u.chat_id, MIN(r.threshold) AS reminded_threshold
+            FROM subscriptions s
+            JOIN users u ON u.telegram_id = s.telegram_id
+            LEFT JOIN reminders_sent r ON r.telegram_id = s.telegram_id AND r.end_date = s.end_date
+            WHERE s.end_date BETWEEN %s AND %s
+            GROUP BY s.telegram_id, s.end_date, u.chat_id
+        """, (today - timedelta(days=grace_days), today + timedelta(days=window_days)))
+        return cursor.fetchall()
+
+def record_reminders(reminders):
+    # reminders: list of (telegram_id, end_date, threshold)
+    if not reminders:
+        return
+    with db_cursor() as cursor:
+        cursor.executemany(
+            "INSERT IGNORE INTO reminders_sent (telegram_id, end_date, threshold) VALUES (%s, %s, %s)",
+            reminders
+        )
+
+# Command set version applied per chat; only changes when the command lists or a role change
+_command_scope_cache = LRUCache(maxsize=int(os.getenv("COMMAND_SCOPE_CACHE_SIZE", 10000)))
+_command_scope_lock = threading.Lock()
+
+def get_command_scope_version(chat_id):
+    with _command_scope_lock:
+        version = _command_scope_cache.get(chat_id, _MISSING)
+    if version is _MISSING:
+        with db_cursor() as cursor:
+            cursor.execute("SELECT version FROM command_scopes WHERE chat_id = %s", (chat_id,))
+            result = cursor.fetchone()
+        version = result[0] if result else None
+        with _command_scope_lock:
+            _command_scope_cache[chat_id] = version
+    return version
+
+def save_command_scope(chat_id, role, version):
+    with db_cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO command_scopes (chat_id, role, version)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE role = %s, version = %s
+        """, (chat_id, role, version, role, version))
+    with _command_scope_lock:
+        _command_scope_cache[chat_id] = version
+
+def clear_caches():
+    # Drop the in-process user, entitlement and command scope caches so the next lookups
+    # read the database (conformance checks, benchmark runs)
+    with _user_cache_lock:
+        _user_cache.clear()
+    entitlements.clear()
+    with _command_scope_lock:
+        _command_scope_cache.clear()
+
+def get_conversation_state(kind, key):
+    # Serialised state for one user or chat, or None if nothing is stored
+    with db_cursor() as cursor:
+        cursor.execute("SELECT data FROM conversation_state WHERE kind = %s AND state_key = %s", (kind, key))
+        result = cursor.fetchone()
+    return result[0] if result else None
+
+def save_conversation_states(changes):
+    # changes: [(kind, key, data)]; data None means the state was emptied
+    upserts = [(kind, key, data) for kind, key, data in changes if data is not None]
+    deletes = [(kind, key) for kind, key, data in changes if data is None]
+    with db_cursor(transaction=True) as cursor:
+        if upserts:
+            cursor.executemany("""
+                INSERT INTO conversation_state (kind, state_key, data)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE data = VALUES(data)
+            """, upserts)
+        if deletes:
+            cursor.executemany("DELETE FROM conversation_state WHERE kind = %s AND state_key = %s", deletes)
+
+BROADCAST_AUDIENCES = ("all", "paid", "unpaid", "expiring", "handshake")
+
+def _audience_sql(audience, days, today):
+    # Returns (joins, where, params) selecting the audience from users u. `today` is the
+    # broadcast's creation date, so the expiring window stays fixed while it runs.
+    if audience == "paid":
+        return "JOIN subscriptions s ON s.telegram_id = u.telegram_id", "s.status = 'active'", ()
+    if audience == "unpaid":
+        return ("LEFT JOIN subscriptions s ON s.telegram_id = u.telegram_id",
+                "(s.telegram_id IS NULL OR s.status <> 'active')", ())
+    if audience == "expiring":
+        return ("JOIN subscriptions s ON s.telegram_id = u.telegram_id",
+                "s.status = 'active' AND s.end_date BETWEEN %s AND %s",
+                (today, today + timedelta(days=days or 0)))
+    if audience == "handshake":
+        return "", "u.first_handshake_at IS NOT NULL", ()
+    return "", "TRUE", ()
+
+def create_broadcast(message, audience, audience_days, created_by):
+    # created_at is stamped here, in the same local time as finished_at and format_status
+    created_at = datetime.now()
+    joins, where, params = _audience_sql(audience, audience_days, created_at.date())
+    with db_cursor(transaction=True) as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM users u {joins} WHERE {where}", params)
+        total = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO broadcasts (message, audience, audience_days, created_by, total, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (message, audience, audience_days, created_by, total, created_at))
+        return cursor.lastrowid
+
+def get_broadcast(broadcast_id):
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT * FROM broadcasts WHERE id = %s", (broadcast_id,))
+        return cursor.fetchone()
+
+def get_recent_broadcasts(limit=5):
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT %s", (limit,))
+        return cursor.fetchall()
+
+def get_running_broadcasts():
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return cursor.fetchall()
+
+def get_broadcast_recipients(broadcast, limit):
+    # Next keyset chunk after the checkpoint, skipping anyone already in the ledger
+    joins, where, params = _audience_sql(broadcast['audience'], broadcast['audience_days'],
+                                         broadcast['created_at'].date())
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"""
+            SELECT u.telegram_id, u.chat_id
+            FROM users u
+            {joins}
+            LEFT JOIN broadcast_deliveries d ON d.broadcast_id = %s AND d.telegram_id = u.telegram_id
+            WHERE u.telegram_id > %s AND d.telegram_id IS NULL AND {where}
+            ORDER BY u.telegram_id
+            LIMIT %s
+        """, (broadcast['id'], broadcast['last_telegram_id'], *params, limit))
+        return cursor.fetchall()
+
+def claim_broadcast_recipients(broadcast_id, telegram_ids):
+    # Recorded before sending, so a crash mid-chunk never leads to a second send
+    with db_cursor() as cursor:
+        cursor.executemany(
+            "INSERT IGNORE INTO broadcast_deliveries (broadcast_id, telegram_id, status) VALUES (%s, %s, 'pending')",
+            [(broadcast_id, telegram_id) for telegram_id in telegram_ids]
+        )
+
+def record_broadcast_chunk(broadcast_id, results, last_telegram_id):
+    # results: list of (telegram_id, status, error)
+    sent = sum(1 for _, status, _ in results if status == "sent")
+    with db_cursor(transaction=True) as cursor:
+        cursor.executemany(
+            "UPDATE broadcast_deliveries SET status = %s, error = %s WHERE broadcast_id = %s AND telegram_id = %s",
+            [(status, error and error[:255], broadcast_id, telegram_id) for telegram_id, status, error in results]
+        )
+        cursor.execute("""
+            UPDATE broadcasts SET sent = sent + %s, failed = failed + %s, last_telegram_id = %s
+            WHERE id = %s
+        """, (sent, len(results) - sent, last_telegram_id, broadcast_id))
+
+def abandon_pending_deliveries(broadcast_id):
+    # Deliveries in flight when the process died may or may not have gone out; never resend them
+    with db_cursor(transaction=True) as cursor:
+        cursor.execute("""
+            UPDATE broadcast_deliveries SET status = 'unknown'
+            WHERE broadcast_id = %s AND status = 'pending'
+        """, (broadcast_id,))
+        cursor.execute("UPDATE broadcasts SET failed = failed + %s WHERE id = %s", (cursor.rowcount, broadcast_id))
+
+def finish_broadcast(broadcast_id, status="done"):
+    with db_cursor() as cursor:
+        cursor.execute("UPDATE broadcasts SET status = %s, finished_at = %s WHERE id = %s",
+                       (status, datetime.now(), broadcast_id))
+
+def get_pending_payments_page(after_id=None, before_id=None, limit=10):
+    return _keyset_page(
+        "SELECT s.telegram_id, u.username FROM subscriptions s JOIN users u ON s.telegram_id = u.telegram_id",
+        "s.payment_confirmed = FALSE", "s.telegram_id",
+        after_id=after_id, before_id=before_id, limit=limit
+    )
+
+_TICKET_SELECT = """
+    SELECT t.id, t.telegram_id, t.message, t.status, t.claimed_by, t.attempts, t.created_at,
+           t.delivered_at, u.username, u.chat_id
+    FROM help_tickets t
+    LEFT JOIN users u ON u.telegram_id = t.telegram_id
+"""
+
+def create_ticket(telegram_id, message):
+    with db_cursor() as cursor:
+        cursor.execute("INSERT INTO help_tickets (telegram_id, message, created_at) VALUES (%s, %s, %s)",
+                       (telegram_id, message, datetime.now()))
+        return cursor.lastrowid
+
+def get_ticket(ticket_id):
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"{_TICKET_SELECT} WHERE t.id = %s", (ticket_id,))
+        return cursor.fetchone()
+
+def get_open_tickets(limit=10):
+    # Oldest first: open tickets, then claimed ones still waiting for an answer
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"{_TICKET_SELECT} WHERE t.status IN ('open', 'claimed') ORDER BY t.id LIMIT %s", (limit,))
+        return cursor.fetchall()
+
+def get_undelivered_tickets(max_attempts, attempted_before, limit=50):
+    # Open tickets no admin has received yet, whose last fan-out is older than attempted_before
+    with db_cursor(dictionary=True) as cursor:
+        cursor.execute(f"""
+            {_TICKET_SELECT}
+            WHERE t.status = 'open' AND t.delivered_at IS NULL AND t.attempts < %s
+              AND (t.last_attempt_at IS NULL OR t.last_attempt_at < %s)
+            ORDER BY t.id LIMIT %s
+        """, (max_attempts, attempted_before, limit))
+        return cursor.fetchall()
+
+def record_ticket_attempt(ticket_id):
+    with db_cursor() as cursor:
+        cursor.execute("UPDATE help_tickets SET attempts = attempts + 1, last_attempt_at = %s WHERE id = %s",
+                       (datetime.now(), ticket_id))
+
+def mark_ticket_delivered(ticket_id):
+    with db_cursor() as cursor:
+        cursor.execute("UPDATE help_tickets SET delivered_at = %s WHERE id = %s AND delivered_at IS NULL",
+                       (datetime.now(), ticket_id))
+
+def claim_ticket(ticket_id, admin_id):
+    # True for the one admin whose claim lands first
+    with db_cursor() as cursor:
+        cursor.execute("""
+            UPDATE help_tickets SET status = 'claimed', claimed_by = %s, claimed_at = %s
+            WHERE id = %s AND status = 'open'
+        """, (admin_id, datetime.now(), ticket_id))
+        return cursor.rowcount == 1
+
+def answer_ticket(ticket_id):
+    with db_cursor() as cursor:
+        cursor.execute("UPDATE help_tickets SET status = 'answered', answered_at = %s WHERE id = %s AND status = 'claimed'",
+                       (datetime.now(), ticket_id))
+        return cursor.rowcount == 1
+
+# Tables /export and `python database.py export` can write, oldest rows first
+EXPORT_QUERIES = {
+    "users": "SELECT telegram_id, username, chat_id, first_handshake_at, last_seen_at FROM users ORDER BY telegram_id",
+    "subscriptions": """
+        SELECT s.telegram_id, u.username, s.start_date, s.end_date, s.status, s.payment_confirmed, s.confirmed_at
         FROM subscriptions s
-        JOIN users u ON s.telegram_id = u.telegram_id
-        WHERE s.payment_confirmed = FALSE
-    """)
-    pending = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return pending
+        LEFT JOIN users u ON u.telegram_id = s.telegram_id
+        ORDER BY s.telegram_id
+    """,
+    "interactions": "SELECT id, telegram_id, message, timestamp FROM interactions ORDER BY id",
+}
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+
+def export_rows(table, out, fmt="csv", chunk_size=None):
+    # Streams a table to the text file `out` and returns the row count. Rows are pulled
+    # from an unbuffered cursor chunk_size at a time and written straight out, so memory
+    # use doesn't grow with the table.
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    total = 0
+    with db_cursor() as cursor:
+        cursor.execute(EXPORT_QUERIES[table])
+        columns = [d[0] for d in cursor.description]
+        writer = csv.writer(out) if fmt == "csv" else None
+        if writer:
+            writer.writerow(columns)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if writer:
+                writer.writerows(rows)
+            else:
+                out.writelines(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows)
+            total += len(rows)
+    return total
+
+def export_filename(table, fmt):
+    return f"{table}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}.gz"
+
+def export_file(table, fmt, path):
+    # gzip compresses as rows arrive; returns the row count
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as out:
+        return export_rows(table, out, fmt)
 
 def test_connection():
     try:
-        conn = get_db_connection()
-        print("Database connection successful!")
-        conn.close()
+        with db_cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        logger.info(f"Database connection successful! ({backend.describe()})")
     except Exception as e:
-        print(f"Database connection failed: {e}")
+        logger.warning(f"Database connection failed: {e}")
+
+# Latency and error counts for every public database call; the connection helpers
+# are context managers and are covered by the calls that use them
+metrics.instrument_module(globals(), exclude=("init_pool", "db_connection", "db_cursor", "pool_stats"))
+metrics.register("bot_db_pool_connections", "Pooled connections checked out",
+                 lambda: {(("state", "in_use"),): pool_stats()['in_use'], (("state", "size"),): pool_stats()['size']})
+metrics.register("bot_interaction_queue_depth", "Interactions waiting to be written",
+                 lambda: interaction_logger.stats()['queue_depth'])
+metrics.register("bot_interactions_total", "Interaction logger outcomes",
+                 lambda: {(("outcome", key),): value for key, value in interaction_logger.stats().items()
+                          if key in ('logged', 'flushed', 'dropped', 'failed')}, kind="counter")
+metrics.register("bot_entitlement_cache_total", "Entitlement cache lookups",
+                 lambda: {(("result", "hit"),): entitlements.stats()['hits'],
+                          (("result", "miss"),): entitlements.stats()['misses']}, kind="counter")
 
 if __name__ == "__main__":
-    setup_database()
-    test_connection()
\ No newline at end of file
+    # python database.py                                   (apply migrations, check the connection)
+    # python database.py export users --format jsonl [--output users.jsonl.gz]
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Set up the bot's database or export a table")
+    commands = parser.add_subparsers(dest="command")
+    export = commands.add_parser("export", help="write a table to a gzip-compressed CSV or JSONL file")
+    export.add_argument("table", choices=list(EXPORT_QUERIES))
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export.add_argument("--output", help="file to write (default: <table>-<timestamp>.<format>.gz)")
+    args = parser.parse_args()
+    if args.command == "export":
+        path = args.output or export_filename(args.table, args.format)
+        logger.info(f"Exported {export_file(args.table, args.format, path)} {args.table} rows to {path}")
+    else:
+        migrate()
+        test_connection()
@@ -0,0 +1,99 @@
+# executors.py
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+import metrics
+
+class KeyedExecutor:
+    # Thread pool that runs tasks with the same key one at a time, in submission order,
+    # while different keys run concurrently. Each task is scheduled separately, so one
+    # busy key can't monopolise a worker.
+    def __init__(self, workers, name):
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            tasks = self._queues.get(key)
+            first = tasks is None
+            if first:
+                tasks = self._queues[key] = deque()
+            tasks.append((fn, args, kwargs, future))
+        if first:
+            self._pool.submit(self._run_next, key)
+        return future
+
+    def _run_next(self, key):
+        with self._lock:
+            fn, args, kwargs, future = self._queues[key][0]
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        with self._lock:
+            tasks = self._queues[key]
+            tasks.popleft()
+            if not tasks:
+                del self._queues[key]
+                return
+        self._pool.submit(self._run_next, key)
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._queues), 'queued': sum(len(tasks) for tasks in self._queues.values())}
+
+    def shutdown(self, wait=True):
+        # Let each key's queue drain; tasks resubmit themselves until their queue is empty
+        if wait:
+            while True:
+                with self._lock:
+                    if not self._queues:
+                        break
+                threading.Event().wait(0.1)
+        self._pool.shutdown(wait=wait)
+
+user_executor = KeyedExecutor(int(os.getenv("HANDLER_WORKERS", 8)), "handler")
+admin_executor = KeyedExecutor(int(os.getenv("ADMIN_WORKERS", 2)), "admin")
+
+queue_seconds = metrics.histogram("bot_handler_queue_seconds", "Time an update waited for its handler to start")
+metrics.register("bot_handler_queue_depth", "Updates waiting in the handler pools",
+                 lambda: {(("pool", e.name),): e.stats()['queued'] for e in (user_executor, admin_executor)})
+
+def _run_handler(callback, update, context, queued_at):
+    queue_seconds.observe(time.perf_counter() - queued_at, handler=callback.__name__)
+    try:
+        return callback(update, context)
+    except Exception as e:
+        context.dispatcher.dispatch_error(update, e)
+    finally:
+        # Handlers finish after the dispatcher moved on, so store their state changes here
+        context.dispatcher.update_persistence(update)
+
+def _offload(executor, callback):
+    callback = metrics.instrument_handler(callback)
+
+    @wraps(callback)
+    def handler(update, context):
+        # Serialise per user so context.user_data transitions stay in order
+        user = update.effective_user
+        key = user.id if user else update.effective_chat.id
+        executor.submit(key, _run_handler, callback, update, context, time.perf_counter())
+    return handler
+
+def run_for_user(callback):
+    return _offload(user_executor, callback)
+
+def run_for_admin(callback):
+    # Long-running admin commands get their own pool so they can't starve user traffic
+    return _offload(admin_executor, callback)
+
+def shutdown():
+    user_executor.shutdown()
+    admin_executor.shutdown()
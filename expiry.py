@@ -0,0 +1,66 @@
+# expiry.py
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Subscriptions stay 'active' until this sweeper moves them to 'expired' the day after
+# their end_date, so has_paid never has to compare dates. Each batch is one indexed
+# UPDATE; a run stops after EXPIRY_MAX_BATCHES and the rest waits for the next run.
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", 500))
+EXPIRY_PAUSE = float(os.getenv("EXPIRY_PAUSE", 0.2))  # Seconds between batches
+EXPIRY_MAX_BATCHES = int(os.getenv("EXPIRY_MAX_BATCHES", 100))
+EXPIRY_INTERVAL = int(os.getenv("EXPIRY_INTERVAL", 900))
+
+_lock = threading.Lock()
+_stop = threading.Event()
+_stats_lock = threading.Lock()
+_stats = {'expired': 0, 'runs': 0, 'last_run_s': 0.0}
+
+def run(notify=None, today=None):
+    # One bounded sweep; notify(rows) is called after each committed batch. Returns the
+    # number of subscriptions expired.
+    if not _lock.acquire(blocking=False):
+        return 0
+    try:
+        started = time.monotonic()
+        today = today or datetime.now().date()
+        expired = batches = 0
+        while batches < EXPIRY_MAX_BATCHES and not _stop.is_set():
+            rows = database.expire_subscriptions(today, EXPIRY_BATCH_SIZE)
+            expired += len(rows)
+            batches += 1
+            if rows and notify is not None:
+                try:
+                    notify(rows)
+                except Exception as e:
+                    logger.error(f"Failed to notify {len(rows)} expired subscribers: {e}")
+            if len(rows) < EXPIRY_BATCH_SIZE:
+                break
+            _stop.wait(EXPIRY_PAUSE)
+        elapsed = time.monotonic() - started
+        with _stats_lock:
+            _stats['expired'] += expired
+            _stats['runs'] += 1
+            _stats['last_run_s'] = elapsed
+        if expired:
+            logger.info(f"Expired {expired} subscriptions in {elapsed:.1f}s")
+        return expired
+    finally:
+        _lock.release()
+
+def stop():
+    # Ends a running sweep at its next batch boundary
+    _stop.set()
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+metrics.register("bot_subscriptions_expired_total", "Subscriptions moved to expired by the sweeper",
+                 lambda: stats()['expired'], kind="counter")
@@ -0,0 +1,198 @@
+# metrics.py
+import inspect
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+STARTED = time.time()
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return {key: value for key, value in self._values.items()}
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(series) for key, series in self._series.items()}
+
+    def quantile(self, series, q):
+        # Upper bound of the bucket holding the q-th observation
+        target = q * series[-2]
+        seen = 0
+        for i, bound in enumerate(self.buckets):
+            seen += series[i]
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.snapshot().items()):
+            labels = dict(key)
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += series[i]
+                lines.append(f"{self.name}_bucket{_labels(dict(labels, le=bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(dict(labels, le='+Inf'))} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {series[-1]:.6f}")
+        return lines
+
+class CallbackMetric:
+    # Gauge or counter read from a component's own stats when scraped
+    def __init__(self, name, help_text, kind, read):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.read = read
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.warning(f"Metric {self.name} failed: {e}")
+            return lines
+        if isinstance(value, dict):
+            for labels, item in sorted(value.items()):
+                lines.append(f"{self.name}{_labels(dict(labels))} {item}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+_registry = []
+
+def counter(name, help_text):
+    metric = Counter(name, help_text)
+    _registry.append(metric)
+    return metric
+
+def histogram(name, help_text):
+    metric = Histogram(name, help_text)
+    _registry.append(metric)
+    return metric
+
+def register(name, help_text, read, kind="gauge"):
+    # read() returns a number, or {((label, value), ...): number}
+    _registry.append(CallbackMetric(name, help_text, kind, read))
+
+def expose():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+handler_seconds = histogram("bot_handler_duration_seconds", "Handler latency")
+handler_errors = counter("bot_handler_errors_total", "Handlers that raised")
+db_seconds = histogram("bot_db_call_duration_seconds", "database.py call latency")
+db_errors = counter("bot_db_errors_total", "database.py calls that raised")
+
+def _timed(callback, histogram_metric, error_counter, **labels):
+    @wraps(callback)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except Exception:
+            error_counter.inc(**labels)
+            raise
+        finally:
+            histogram_metric.observe(time.perf_counter() - started, **labels)
+    return timed
+
+def instrument_handler(callback):
+    return _timed(callback, handler_seconds, handler_errors, handler=callback.__name__)
+
+def instrument_module(namespace, exclude=()):
+    # Wraps the public functions of a module (pass its globals()) with latency/error tracking
+    for name, value in list(namespace.items()):
+        # Generators are skipped: timing them would only measure their creation
+        if (name.startswith("_") or name in exclude or not inspect.isfunction(value)
+                or inspect.isgeneratorfunction(value) or value.__module__ != namespace["__name__"]):
+            continue
+        namespace[name] = _timed(value, db_seconds, db_errors, function=name)
+
+def summary(histogram_metric, label, top=10):
+    # [(label value, calls, avg ms, ~p99 ms)] sorted by total time spent
+    rows = []
+    for key, series in histogram_metric.snapshot().items():
+        count = series[-2]
+        if count:
+            rows.append((dict(key)[label], count, series[-1] / count * 1000,
+                         histogram_metric.quantile(series, 0.99) * 1000, series[-1]))
+    rows.sort(key=lambda row: row[4], reverse=True)
+    return [row[:4] for row in rows[:top]]
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port=None, address=None):
+    # Standalone /metrics endpoint (METRICS_PORT); webhook mode also serves it on the webhook port
+    port = port or os.getenv("METRICS_PORT")
+    if not port:
+        return None
+    server = ThreadingHTTPServer((address or os.getenv("METRICS_LISTEN", "0.0.0.0"), int(port)), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Serving /metrics on port {port}")
+    return server
@@ -0,0 +1,133 @@
+# persistence.py
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class LazyStateDict(defaultdict):
+    # user_data/chat_data mapping that loads an id's stored state the first time it is touched,
+    # so startup doesn't read every row
+    def __init__(self, loader, *args):
+        super().__init__(dict, *args)
+        self._loader = loader
+
+    def __missing__(self, key):
+        value = self[key] = self._loader(key)
+        return value
+
+    def __copy__(self):
+        # BasePersistence copies the mapping on load; keep the loader on the copy
+        return type(self)(self._loader, self)
+
+    copy = __copy__
+
+class MySQLPersistence(BasePersistence):
+    # Stores user_data and chat_data as one JSON row per id. The dispatcher reports state
+    # after every update; only ids whose state actually changed are marked dirty, and a
+    # background thread writes them out together every flush_interval seconds.
+    def __init__(self, flush_interval, store_user_data=True, store_chat_data=True):
+        super().__init__(store_user_data=store_user_data, store_chat_data=store_chat_data,
+                         store_bot_data=False, store_callback_data=False)
+        self.flush_interval = flush_interval
+        self._saved = {}  # (kind, id) -> last serialised state seen
+        self._dirty = {}  # (kind, id) -> serialised state waiting to be written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'loaded': 0, 'marked': 0, 'written': 0, 'flushes': 0, 'failed': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="persistence-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, dirty=len(self._dirty))
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _load(self, kind, key):
+        data = database.get_conversation_state(kind, key)
+        with self._lock:
+            self._saved[(kind, key)] = data
+            self._stats['loaded'] += 1
+        return json.loads(data) if data else {}
+
+    def _mark(self, kind, key, data):
+        payload = json.dumps(data, sort_keys=True, default=str) if data else None
+        with self._lock:
+            if self._saved.get((kind, key)) == payload:
+                return
+            self._saved[(kind, key)] = payload
+            self._dirty[(kind, key)] = payload
+            self._stats['marked'] += 1
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            try:
+                database.save_conversation_states([(kind, key, data) for (kind, key), data in dirty.items()])
+            except Exception as e:
+                # Put the batch back unless a newer state for the same id arrived meanwhile
+                with self._lock:
+                    for state_key, data in dirty.items():
+                        self._dirty.setdefault(state_key, data)
+                    self._stats['failed'] += 1
+                logger.error(f"Failed to save conversation state for {len(dirty)} ids: {e}")
+                return
+            with self._lock:
+                self._stats['written'] += len(dirty)
+                self._stats['flushes'] += 1
+
+    def get_user_data(self):
+        return LazyStateDict(lambda key: self._load("user", key))
+
+    def get_chat_data(self):
+        return LazyStateDict(lambda key: self._load("chat", key))
+
+    def update_user_data(self, user_id, data):
+        self._mark("user", user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._mark("chat", chat_id, data)
+
+    # Bot data, callback data and ConversationHandler state aren't used by this bot
+    def get_bot_data(self):
+        return {}
+
+    def update_bot_data(self, data):
+        pass
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+persistence = MySQLPersistence(flush_interval=float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 2)))
+
+metrics.register("bot_conversation_state_dirty", "Conversation states waiting to be written",
+                 lambda: persistence.stats()['dirty'])
+metrics.register("bot_conversation_state_writes_total", "Conversation states written",
+                 lambda: persistence.stats()['written'], kind="counter")
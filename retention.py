@@ -0,0 +1,85 @@
+# retention.py
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Raw interactions stay in the live table for RETENTION_DAYS, then are rolled up into
+# interaction_daily and moved to interactions_archive, which keeps them for ARCHIVE_DAYS
+# more (0 skips the archive and drops raw rows straight after the rollup).
+RETENTION_DAYS = int(os.getenv("INTERACTION_RETENTION_DAYS", 90))
+ARCHIVE_DAYS = int(os.getenv("INTERACTION_ARCHIVE_DAYS", 365))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 1000))
+RETENTION_PAUSE = float(os.getenv("RETENTION_PAUSE", 0.5))  # Seconds between batches
+RETENTION_MAX_BATCHES = int(os.getenv("RETENTION_MAX_BATCHES", 200))  # Per run; the rest waits for the next run
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 3600))
+
+_lock = threading.Lock()
+_stop = threading.Event()
+_stats_lock = threading.Lock()
+_stats = {'retired': 0, 'purged': 0, 'runs': 0, 'last_run_s': 0.0}
+
+def _drain(step, before, budget):
+    # Runs step(before, batch_size) until it comes back short or the batch budget is spent,
+    # pausing between batches so live inserts and reads keep the table most of the time
+    total = batches = 0
+    while batches < budget and not _stop.is_set():
+        done = step(before, RETENTION_BATCH_SIZE)
+        total += done
+        batches += 1
+        if done < RETENTION_BATCH_SIZE:
+            break
+        _stop.wait(RETENTION_PAUSE)
+    return total, batches
+
+def run(now=None):
+    # One bounded retention pass; returns (rows retired, archived rows purged)
+    if not _lock.acquire(blocking=False):
+        return 0, 0
+    try:
+        started = time.monotonic()
+        now = now or datetime.now()
+        retired, batches = _drain(
+            lambda before, size: database.retire_interactions(before, size, archive=ARCHIVE_DAYS > 0),
+            now - timedelta(days=RETENTION_DAYS), RETENTION_MAX_BATCHES
+        )
+        purged = 0
+        if ARCHIVE_DAYS > 0:
+            purged, _ = _drain(database.purge_interaction_archive,
+                               now - timedelta(days=RETENTION_DAYS + ARCHIVE_DAYS),
+                               RETENTION_MAX_BATCHES - batches)
+        elapsed = time.monotonic() - started
+        with _stats_lock:
+            _stats['retired'] += retired
+            _stats['purged'] += purged
+            _stats['runs'] += 1
+            _stats['last_run_s'] = elapsed
+        if retired or purged:
+            logger.info(f"Retention: retired {retired} interactions, purged {purged} archived in {elapsed:.1f}s")
+        return retired, purged
+    finally:
+        _lock.release()
+
+def job(context):
+    try:
+        run()
+    except Exception as e:
+        logger.error(f"Retention job failed: {e}")
+
+def stop():
+    # Ends a running pass at its next batch boundary
+    _stop.set()
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+metrics.register("bot_interactions_retired_total", "Interactions rolled up and moved out of the live table",
+                 lambda: stats()['retired'], kind="counter")
+metrics.register("bot_interactions_purged_total", "Archived interactions dropped past the horizon",
+                 lambda: stats()['purged'], kind="counter")
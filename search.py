@@ -0,0 +1,68 @@
+# search.py
+import threading
+from collections import defaultdict
+
+class NgramIndex:
+    # In-memory n-gram index for substring matches. Each document is indexed under
+    # every n-gram of its searchable fields; a query's candidates are the intersection
+    # of its n-gram postings, then verified with a real substring check.
+    def __init__(self, n=3):
+        self.n = n
+        self.ready = False
+        self._postings = defaultdict(set)
+        self._docs = {}
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def _grams(self, fields):
+        grams = set()
+        for field in fields:
+            grams.update(field[i:i + self.n] for i in range(len(field) - self.n + 1))
+        return grams
+
+    def add(self, key, fields, doc):
+        fields = tuple(field.lower() for field in fields if field)
+        with self._lock:
+            self._remove(key)
+            self._docs[key] = doc
+            self._fields[key] = fields
+            for gram in self._grams(fields):
+                self._postings[gram].add(key)
+
+    def _remove(self, key):
+        fields = self._fields.pop(key, None)
+        if fields is None:
+            return
+        self._docs.pop(key, None)
+        for gram in self._grams(fields):
+            keys = self._postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[gram]
+
+    def build(self, entries):
+        # entries: iterable of (key, fields, doc). The caller sets `ready` once changes made
+        # while the entries were being read have been applied too.
+        for key, fields, doc in entries:
+            self.add(key, fields, doc)
+
+    def search(self, text, limit):
+        # Returns matching docs, or None when the query is too short for the index
+        text = text.lower()
+        if len(text) < self.n:
+            return None
+        with self._lock:
+            postings = [self._postings.get(gram, set()) for gram in self._grams((text,))]
+            postings.sort(key=len)
+            candidates = set.intersection(*postings) if postings else set()
+            matches = []
+            for key in candidates:
+                if any(text in field for field in self._fields[key]):
+                    matches.append(self._docs[key])
+                    if len(matches) >= limit:
+                        break
+            return matches
+
+    def __len__(self):
+        return len(self._docs)
@@ -0,0 +1,239 @@
+# sender.py
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from cachetools import TTLCache
+from telegram.error import BadRequest, NetworkError, RetryAfter
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Block until a token is available
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class _SendJob:
+    def __init__(self, method, chat_id, kwargs, chat_arg="chat_id", bulk=False):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.chat_arg = chat_arg
+        self.bulk = bulk
+        self.future = Future()
+        self.attempts = 0
+
+class SendScheduler:
+    # Central outbound queue. A worker pool sends concurrently under a global token
+    # bucket; each chat is handled by one worker at a time and spaced by the per-chat
+    # rate, so messages to the same chat keep their order. Bulk sends (broadcasts, batch
+    # notifications) wait in a second lane that is only served when no interactive chat is
+    # due, so replies and relays don't queue behind thousands of broadcast messages.
+    def __init__(self, workers, global_rate, per_chat_rate, max_retries, max_backoff):
+        self.workers = workers
+        self.per_chat_interval = 1.0 / per_chat_rate
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._bot = None
+        self._pending = {}  # chat_id -> deque of jobs
+        self._ready = []  # heap of (ready_at, seq, chat_id); a chat is here at most once
+        self._bulk_ready = []  # same, for chats whose next job is bulk
+        self._scheduled = set()
+        self._next_send = TTLCache(maxsize=100000, ttl=60)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._stats = {'sent': 0, 'failed': 0, 'retried': 0}
+
+    def start(self, bot):
+        self._bot = bot
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"sender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=30):
+        # Let queued messages go out, then release the workers
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending and time.monotonic() < deadline:
+                self._cond.wait(0.5)
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self._threads = []
+
+    def submit(self, method, chat_id, chat_arg="chat_id", bulk=False, **kwargs):
+        return self.submit_many(method, [(chat_id, kwargs)], chat_arg, bulk)[0]
+
+    def submit_many(self, method, messages, chat_arg="chat_id", bulk=False):
+        # messages: [(chat_id, kwargs)], queued together under one lock; returns their futures.
+        # chat_arg is the parameter the chat_id is passed as, or None for calls that are only
+        # queued and rate-limited per chat (e.g. set_my_commands with a chat scope).
+        # bulk=True puts the jobs in the low-priority lane.
+        jobs = [_SendJob(method, chat_id, kwargs, chat_arg, bulk) for chat_id, kwargs in messages]
+        if self._bot is None:
+            for job in jobs:
+                job.future.set_exception(RuntimeError("Send scheduler is not running"))
+            return [job.future for job in jobs]
+        with self._cond:
+            for job in jobs:
+                pending = self._pending.get(job.chat_id)
+                if pending is None:
+                    pending = self._pending[job.chat_id] = deque()
+                pending.append(job)
+                if job.chat_id not in self._scheduled and len(pending) == 1:
+                    self._schedule(job.chat_id, self._next_send.get(job.chat_id, 0))
+        return [job.future for job in jobs]
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit("send_message", chat_id, text=text, **kwargs)
+
+    def stats(self):
+        with self._cond:
+            queued = sum(len(jobs) for jobs in self._pending.values())
+            return dict(self._stats, queued=queued, chats=len(self._pending))
+
+    def _schedule(self, chat_id, ready_at):
+        # Caller holds self._cond. The chat's next job picks the lane.
+        self._scheduled.add(chat_id)
+        lane = self._bulk_ready if self._pending[chat_id][0].bulk else self._ready
+        heapq.heappush(lane, (ready_at, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _next_chat(self):
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                now = time.monotonic()
+                for lane in (self._ready, self._bulk_ready):
+                    if lane and lane[0][0] <= now:
+                        chat_id = heapq.heappop(lane)[2]
+                        self._scheduled.discard(chat_id)
+                        return chat_id
+                due = [lane[0][0] for lane in (self._ready, self._bulk_ready) if lane]
+                self._cond.wait(min(due) - now if due else None)
+
+    def _run(self):
+        while True:
+            chat_id = self._next_chat()
+            if chat_id is None:
+                return
+            with self._cond:
+                job = self._pending[chat_id][0]
+            retry_in = self._send(job)
+            with self._cond:
+                jobs = self._pending[chat_id]
+                if retry_in is None:
+                    jobs.popleft()
+                    next_at = time.monotonic() + self.per_chat_interval
+                    self._next_send[chat_id] = next_at
+                else:
+                    next_at = time.monotonic() + retry_in
+                if jobs:
+                    self._schedule(chat_id, next_at)
+                else:
+                    del self._pending[chat_id]
+                    self._cond.notify_all()
+
+    def _send(self, job):
+        # Returns None once the job is settled, or the delay before retrying it
+        self._bucket.acquire()
+        job.attempts += 1
+        try:
+            kwargs = dict(job.kwargs, **{job.chat_arg: job.chat_id}) if job.chat_arg else job.kwargs
+            result = getattr(self._bot, job.method)(**kwargs)
+        except RetryAfter as e:
+            return self._retry(job, e, e.retry_after)
+        except BadRequest as e:
+            return self._fail(job, e)
+        except NetworkError as e:
+            return self._retry(job, e, min(self.max_backoff, 2 ** (job.attempts - 1)))
+        except Exception as e:
+            return self._fail(job, e)
+        with self._cond:
+            self._stats['sent'] += 1
+        job.future.set_result(result)
+        return None
+
+    def _retry(self, job, error, delay):
+        if job.attempts > self.max_retries:
+            return self._fail(job, error)
+        logger.warning(f"Retrying {job.method} to chat_id {job.chat_id} in {delay}s: {error}")
+        with self._cond:
+            self._stats['retried'] += 1
+        return delay
+
+    def _fail(self, job, error):
+        with self._cond:
+            self._stats['failed'] += 1
+        job.future.set_exception(error)
+        return None
+
+scheduler = SendScheduler(
+    workers=int(os.getenv("SEND_WORKERS", 8)),
+    global_rate=float(os.getenv("SEND_RATE", 30)),
+    per_chat_rate=float(os.getenv("SEND_PER_CHAT_RATE", 1)),
+    max_retries=int(os.getenv("SEND_MAX_RETRIES", 5)),
+    max_backoff=float(os.getenv("SEND_MAX_BACKOFF", 30))
+)
+
+metrics.register("bot_sends_total", "Outbound Telegram calls by outcome",
+                 lambda: {(("outcome", key),): value for key, value in scheduler.stats().items()
+                          if key in ('sent', 'failed', 'retried')}, kind="counter")
+metrics.register("bot_send_queue_depth", "Outbound messages waiting to be sent", lambda: scheduler.stats()['queued'])
+
+def start(bot):
+    scheduler.start(bot)
+
+def stop(timeout=30):
+    scheduler.stop(timeout)
+
+def send_message(chat_id, text, **kwargs):
+    return scheduler.send_message(chat_id, text, **kwargs)
+
+def set_my_commands(chat_id, commands, scope, bulk=False):
+    return scheduler.submit("set_my_commands", chat_id, chat_arg=None, bulk=bulk, commands=commands, scope=scope)
+
+def send_many(messages, bulk=False, **kwargs):
+    # messages: [(chat_id, text)] sharing the same options, e.g. a batch of notifications
+    return scheduler.submit_many("send_message", [(chat_id, dict(kwargs, text=text)) for chat_id, text in messages],
+                                 bulk=bulk)
+
+def on_done(future, on_success=None, on_failure=None):
+    # Run a callback when a send settles, without blocking the caller
+    def callback(done):
+        error = done.exception()
+        if error is None:
+            if on_success:
+                on_success(done.result())
+        elif on_failure:
+            on_failure(error)
+    future.add_done_callback(callback)
+    return future
@@ -0,0 +1,289 @@
+# storage.py
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+import mysql.connector
+from mysql.connector import pooling
+
+logger = logging.getLogger(__name__)
+
+# Connection backends for database.py. Queries are written once, in MySQL syntax; each
+# backend hands out connections with the same small API (cursor(dictionary=...),
+# start_transaction, commit, rollback) plus the few schema helpers that differ.
+
+class MySQLBackend:
+    name = "mysql"
+
+    def __init__(self, config, ping_interval, timeout):
+        self.config = config
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._in_use = 0
+
+    def describe(self):
+        return f"mysql {self.config['host']}:{self.config['port']}/{self.config['database']}"
+
+    def init(self, size=None):
+        with self._lock:
+            if self._pool is not None:
+                return self._pool
+            size = size or int(os.getenv("DB_POOL_SIZE", 5))
+            # Every statement commits on its own; multi-statement work uses transaction=True.
+            # Skipping the session reset keeps returning a connection free of round trips.
+            self._pool = pooling.MySQLConnectionPool(
+                pool_name="bts_bot",
+                pool_size=size,
+                pool_reset_session=False,
+                autocommit=True,
+                **self.config
+            )
+            self._slots = threading.BoundedSemaphore(size)
+        logger.info(f"Database pool ready: {size} connections to {self.describe()}")
+        return self._pool
+
+    @contextmanager
+    def connection(self):
+        if self._pool is None:
+            self.init()
+        # The pool raises instead of waiting when it is exhausted, so block on a slot first
+        if not self._slots.acquire(timeout=self.timeout):
+            raise pooling.PoolError("Timed out waiting for a database connection")
+        conn = None
+        with self._lock:
+            self._in_use += 1
+        try:
+            conn = self._pool.get_connection()
+            key = id(conn._cnx)
+            # Only health-check connections that sat idle long enough to have gone stale
+            if time.monotonic() - self._last_used.get(key, 0) > self.ping_interval:
+                conn.ping(reconnect=True, attempts=3, delay=1)
+            yield conn
+            self._last_used[key] = time.monotonic()
+        finally:
+            if conn is not None:
+                conn.close()
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self._pool.pool_size if self._pool else 0, 'in_use': self._in_use}
+
+    def create_index(self, cursor, name, table, columns):
+        # MySQL has no CREATE INDEX IF NOT EXISTS; ignore "duplicate key name"
+        try:
+            cursor.execute(f"CREATE INDEX {name} ON {table} ({columns})")
+        except mysql.connector.Error as e:
+            if e.errno != 1061:
+                raise
+
+    def column_exists(self, cursor, table, column):
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, column))
+        return cursor.fetchone()[0] > 0
+
+    def table_exists(self, cursor, table):
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = %s
+        """, (table,))
+        return cursor.fetchone()[0] > 0
+
+    def index_exists(self, cursor, table, name):
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """, (table, name))
+        return cursor.fetchone()[0] > 0
+
+@lru_cache(maxsize=1024)
+def translate(sql):
+    # Rewrites the MySQL dialect database.py uses into SQLite; cached per statement text
+    sql = sql.replace("%s", "?").replace("INSERT IGNORE", "INSERT OR IGNORE")
+    sql = sql.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT DO UPDATE SET")
+    sql = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", sql)
+    sql = sql.replace("INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT")
+    # Transactions start with BEGIN IMMEDIATE, which already locks out other writers
+    sql = sql.replace(" FOR UPDATE", "")
+    return sql.replace(" ON UPDATE CURRENT_TIMESTAMP", "")
+
+# DATETIME columns come back as datetime objects, like DATE and TIMESTAMP already do
+sqlite3.register_converter("DATETIME", sqlite3.converters["TIMESTAMP"])
+
+class SQLiteCursor:
+    def __init__(self, conn, dictionary):
+        self._cursor = conn.cursor()
+        self._dictionary = dictionary
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(translate(sql), params)
+
+    def executemany(self, sql, seq):
+        self._cursor.executemany(translate(sql), seq)
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return {d[0]: value for d, value in zip(self._cursor.description, row)}
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def fetchmany(self, size):
+        return [self._row(row) for row in self._cursor.fetchmany(size)]
+
+    def __iter__(self):
+        for row in self._cursor:
+            yield self._row(row)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def close(self):
+        self._cursor.close()
+
+class SQLiteConnection:
+    def __init__(self, conn, cursor_class):
+        self.conn = conn
+        self.cursor_class = cursor_class
+
+    def cursor(self, dictionary=False):
+        return self.cursor_class(self.conn, dictionary)
+
+    def start_transaction(self):
+        # Take the write lock up front so two writers can't deadlock upgrading a read lock
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+
+    def rollback(self):
+        self.conn.execute("ROLLBACK")
+
+class SQLiteBackend:
+    # Embedded database for local runs, CI and small deployments. A file database runs in
+    # WAL mode so readers never wait for the writer; ":memory:" is a single shared connection.
+    name = "sqlite"
+    cursor_class = SQLiteCursor
+
+    def __init__(self, path, timeout, cache_size=256):
+        self.path = path
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._idle = queue.LifoQueue()
+        self._slots = None
+        self._lock = threading.Lock()
+        self._size = 0
+        self._opened = 0
+        self._in_use = 0
+
+    def describe(self):
+        return f"sqlite {self.path}"
+
+    def init(self, size=None):
+        with self._lock:
+            if self._slots is not None:
+                return self
+            size = 1 if self.path == ":memory:" else size or int(os.getenv("DB_POOL_SIZE", 5))
+            self._size = size
+            self._slots = threading.BoundedSemaphore(size)
+        logger.info(f"Database ready: {self.describe()} ({size} connections)")
+        return self
+
+    def _connect(self):
+        # sqlite3 prepares each statement once per connection and reuses it from its cache
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=self.cache_size)
+        if self.path != ":memory:":
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return SQLiteConnection(conn, self.cursor_class)
+
+    @contextmanager
+    def connection(self):
+        if self._slots is None:
+            self.init()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("Timed out waiting for a database connection")
+        with self._lock:
+            self._in_use += 1
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+                with self._lock:
+                    self._opened += 1
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self._size, 'in_use': self._in_use, 'opened': self._opened}
+
+    def create_index(self, cursor, name, table, columns):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+    def column_exists(self, cursor, table, column):
+        cursor.execute(f"PRAGMA table_info({table})")
+        return any(row[1] == column for row in cursor.fetchall())
+
+    def table_exists(self, cursor, table):
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = %s", (table,))
+        return cursor.fetchone()[0] > 0
+
+    def index_exists(self, cursor, table, name):
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+                       (table, name))
+        return cursor.fetchone()[0] > 0
+
+def mysql_config():
+    return {
+        "host": os.getenv("DB_HOST") or "mysql.railway.internal",
+        "port": int(os.getenv("DB_PORT", 3306)),
+        "user": os.getenv("DB_USER") or "root",
+        "password": os.getenv("DB_PASSWORD") or "qItgFGuqsyxICAvhiBitaijtiQZuujAD",
+        "database": os.getenv("DB_NAME") or "railway",
+    }
+
+def create_backend(name=None):
+    # DB_BACKEND=mysql (default) or sqlite; SQLITE_PATH picks the database file
+    name = (name or os.getenv("DB_BACKEND", "mysql")).lower()
+    timeout = float(os.getenv("DB_POOL_TIMEOUT", 10))
+    if name == "sqlite":
+        return SQLiteBackend(os.getenv("SQLITE_PATH", "bot.db"), timeout)
+    if name == "mysql":
+        return MySQLBackend(mysql_config(), int(os.getenv("DB_POOL_PING_INTERVAL", 60)), timeout)
+    raise ValueError(f"Unknown DB_BACKEND {name!r}")
@@ -0,0 +1,57 @@
+# tickets.py
+import logging
+import os
+from datetime import datetime, timedelta
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import database
+import sender
+
+logger = logging.getLogger(__name__)
+
+# Help requests are stored as tickets and sent to every admin in the background. The
+# sender retries transient failures itself; a ticket no admin received at all is sent
+# again by the redelivery job, up to TICKET_MAX_ATTEMPTS fan-outs.
+TICKET_RETRY_INTERVAL = int(os.getenv("TICKET_RETRY_INTERVAL", 120))
+TICKET_MAX_ATTEMPTS = int(os.getenv("TICKET_MAX_ATTEMPTS", 5))
+
+def claim_keyboard(ticket_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(f"Claim #{ticket_id}", callback_data=f"ticket_{ticket_id}")]])
+
+def format_ticket(ticket):
+    username = ticket['username'] or "NoUsername"
+    return f"Help request #{ticket['id']} from {username} (ID: {ticket['telegram_id']}):\n{ticket['message']}"
+
+def open_ticket(telegram_id, username, message, admin_ids):
+    # Stores the request and queues the fan-out; returns the ticket id without waiting on sends
+    ticket_id = database.create_ticket(telegram_id, message)
+    fan_out({'id': ticket_id, 'telegram_id': telegram_id, 'username': username, 'message': message}, admin_ids)
+    return ticket_id
+
+def fan_out(ticket, admin_ids):
+    ticket_id = ticket['id']
+    database.record_ticket_attempt(ticket_id)
+    futures = sender.send_many([(admin_id, format_ticket(ticket)) for admin_id in admin_ids],
+                               reply_markup=claim_keyboard(ticket_id))
+    for admin_id, future in zip(admin_ids, futures):
+        sender.on_done(
+            future,
+            on_success=lambda _: database.mark_ticket_delivered(ticket_id),
+            on_failure=lambda e, admin_id=admin_id: logger.warning(f"Failed to send ticket #{ticket_id} to admin {admin_id}: {e}")
+        )
+
+def redeliver(admin_ids):
+    # Sends again the open tickets that reached no admin; returns how many were queued
+    cutoff = datetime.now() - timedelta(seconds=TICKET_RETRY_INTERVAL)
+    tickets = database.get_undelivered_tickets(TICKET_MAX_ATTEMPTS, cutoff)
+    for ticket in tickets:
+        fan_out(ticket, admin_ids)
+    if tickets:
+        logger.info(f"Redelivering {len(tickets)} help tickets")
+    return len(tickets)
+
+def job(context):
+    # Scheduled with the admin ids as the job context
+    try:
+        redeliver(context.job.context)
+    except Exception as e:
+        logger.error(f"Ticket redelivery failed: {e}")
@@ -0,0 +1,126 @@
+# webhook.py
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+import tornado.web
+from telegram.error import Unauthorized
+from telegram.ext import Updater
+from telegram.ext.utils.webhookhandler import WebhookHandler, WebhookServer
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base URL Telegram posts to, e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or 8443)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+HEALTH_PATH = os.getenv("HEALTH_PATH", "/healthz")
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+class SecretWebhookHandler(WebhookHandler):
+    # Rejects posts that don't carry the secret Telegram was given in setWebhook
+    def initialize(self, bot, update_queue, secret_token=None):
+        super().initialize(bot, update_queue)
+        self.secret_token = secret_token
+
+    def _validate_post(self):
+        super()._validate_post()
+        header = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if self.secret_token and not hmac.compare_digest(header, self.secret_token):
+            raise tornado.web.HTTPError(403)
+
+class HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, updater):
+        self.updater = updater
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({
+            "status": "ok" if self.updater.running else "stopping",
+            "mode": "webhook",
+            "update_queue": self.updater.update_queue.qsize(),
+        }))
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.expose())
+
+class WebhookApp(tornado.web.Application):
+    def __init__(self, updater, webhook_path, secret_token):
+        webhook_args = {"bot": updater.bot, "update_queue": updater.update_queue, "secret_token": secret_token}
+        handlers = [
+            (rf"{webhook_path}/?", SecretWebhookHandler, webhook_args),
+            (HEALTH_PATH, HealthHandler, {"updater": updater}),
+            (METRICS_PATH, MetricsHandler),
+        ]
+        super().__init__(handlers)
+
+    def log_request(self, handler):
+        pass
+
+class BotUpdater(Updater):
+    # Updater whose webhook server checks a secret token and serves a health endpoint.
+    # Polling is unchanged; starting it deletes any webhook, so modes switch cleanly.
+    webhook_secret = None
+    # Run first in stop(), before the job queue shuts down and waits for running jobs
+    before_stop = ()
+
+    def stop(self):
+        for callback in self.before_stop:
+            callback()
+        super().stop()
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, drop_pending_updates,
+                       webhook_url, allowed_updates, ready=None, ip_address=None, max_connections=40):
+        if not url_path.startswith("/"):
+            url_path = f"/{url_path}"
+        app = WebhookApp(self, url_path, self.webhook_secret)
+        self.httpd = WebhookServer(listen, port, app, None)
+        self._set_webhook(webhook_url, bootstrap_retries, drop_pending_updates, allowed_updates, max_connections)
+        self.httpd.serve_forever(ready=ready)
+
+    def _set_webhook(self, webhook_url, retries, drop_pending_updates, allowed_updates, max_connections):
+        attempt = 0
+        while True:
+            try:
+                self.bot.set_webhook(
+                    url=webhook_url,
+                    allowed_updates=allowed_updates,
+                    drop_pending_updates=drop_pending_updates,
+                    max_connections=max_connections,
+                    api_kwargs={"secret_token": self.webhook_secret} if self.webhook_secret else None
+                )
+                return
+            except Unauthorized:
+                raise
+            except Exception as e:
+                attempt += 1
+                if 0 <= retries < attempt:
+                    raise
+                logger.warning(f"Failed to set webhook ({e}), retrying in 5 seconds...")
+                time.sleep(5)
+
+def start_webhook(updater):
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL")
+    secret = WEBHOOK_SECRET
+    if not secret:
+        # Fine for a single instance; set WEBHOOK_SECRET when running several behind a load balancer
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET not set, generated a per-process secret")
+    updater.webhook_secret = secret
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    logger.info(f"Listening for webhooks on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} (health at {HEALTH_PATH}, metrics at {METRICS_PATH})")
+    updater.start_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=url,
+        bootstrap_retries=-1
+    )